@@ -0,0 +1,1153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for preparing and interrogating volumetric parcellations (atlases),
+e.g. the parc.nii.gz used throughout the WiMSE notebooks.
+"""
+
+
+def _atlasArray(atlasIn):
+    """
+    Returns the label data of an atlas image or array as an integer array.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas.  For images, the stored (integer) data is used directly
+        rather than a float64 copy from get_fdata.
+
+    Returns
+    -------
+    atlasData : numpy.ndarray
+        Integer array of labels.
+
+    """
+    import numpy as np
+
+    if hasattr(atlasIn,'dataobj'):
+        cachedVolume=getattr(atlasIn,'_wimseLabelVolume',None)
+        if cachedVolume is not None and cachedVolume[0] is atlasIn.dataobj:
+            return cachedVolume[1]
+        atlasIn=np.asanyarray(atlasIn.dataobj)
+    atlasData=np.asarray(atlasIn)
+    if not np.issubdtype(atlasData.dtype,np.integer):
+        #labels loaded via get_fdata are whole numbers stored as floats
+        atlasData=np.rint(atlasData).astype(np.int64)
+    return atlasData
+
+
+def minimalIntegerDtype(minValue, maxValue):
+    """
+    Returns the smallest integer dtype able to hold every value between
+    minValue and maxValue.
+
+    Parameters
+    ----------
+    minValue : int
+        The smallest value to hold.
+    maxValue : int
+        The largest value to hold.
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        e.g. uint8 for labels 0-189, int16 for labels -1-1000.
+
+    """
+    import numpy as np
+
+    return np.result_type(np.min_scalar_type(int(minValue)),np.min_scalar_type(int(maxValue)))
+
+
+def relabelAtlas(atlasIn, oldLabels, newLabels=None, unmappedValue=None, maxLookupSize=2**24):
+    """
+    Relabels an atlas in a single pass over the volume, rather than with one
+    full-volume comparison per label.  When the labels span a modest range a
+    lookup table indexed by label value is used, otherwise the labels are
+    matched with np.searchsorted.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas to relabel.
+    oldLabels : array-like of int
+        The labels to replace, e.g. uniqueAtlasEntries.
+    newLabels : array-like of int, optional
+        The value each of oldLabels is replaced with.  The default is
+        range(len(oldLabels)), i.e. the renumbering used by the notebooks to
+        prepare a label_volume for dipy's connectivity_matrix.
+    unmappedValue : int, optional
+        Value given to voxels whose label is not in oldLabels.  The default
+        is None, which leaves those voxels' labels unchanged.
+    maxLookupSize : int, optional
+        Largest label range for which a lookup table is used.  The default
+        is 2**24.
+
+    Returns
+    -------
+    relabeledData : numpy.ndarray
+        The relabeled atlas, in the smallest integer dtype able to hold the
+        output labels.
+
+    """
+    import numpy as np
+
+    atlasData=_atlasArray(atlasIn)
+    oldLabels=np.asarray(oldLabels,dtype=np.int64).reshape(-1)
+    if newLabels is None:
+        newLabels=np.arange(len(oldLabels),dtype=np.int64)
+    newLabels=np.asarray(newLabels,dtype=np.int64).reshape(-1)
+    if len(oldLabels)!=len(newLabels):
+        raise ValueError('oldLabels and newLabels must be the same length')
+
+    if atlasData.size==0:
+        return atlasData.astype(np.uint8)
+    dataMin=int(atlasData.min())
+    dataMax=int(atlasData.max())
+
+    #work out the range of the output to pick its dtype
+    outputValues=list(newLabels)
+    if unmappedValue is None:
+        outputValues=outputValues+[dataMin,dataMax]
+    else:
+        outputValues=outputValues+[unmappedValue]
+    outDtype=minimalIntegerDtype(min(outputValues),max(outputValues))
+
+    #labels outside of the atlas' range can't match anything
+    inRange=np.logical_and(oldLabels>=dataMin,oldLabels<=dataMax)
+    oldLabels=oldLabels[inRange]
+    newLabels=newLabels[inRange]
+
+    #non-negative labels can index the lookup table directly, without an offset copy
+    lookupStart=min(dataMin,0)
+    if dataMax-lookupStart<maxLookupSize:
+        if unmappedValue is None:
+            lookupTable=np.arange(lookupStart,dataMax+1).astype(outDtype)
+        else:
+            lookupTable=np.full(dataMax-lookupStart+1,unmappedValue,dtype=outDtype)
+        lookupTable[oldLabels-lookupStart]=newLabels
+        if lookupStart==0:
+            return lookupTable[atlasData]
+        return lookupTable[atlasData.astype(np.int64)-lookupStart]
+
+    #sparse label values, so match them by sorting instead
+    labelOrder=np.argsort(oldLabels)
+    sortedOld=oldLabels[labelOrder]
+    sortedNew=newLabels[labelOrder].astype(outDtype)
+    if len(sortedOld)==0:
+        if unmappedValue is None:
+            return atlasData.astype(outDtype)
+        return np.full(atlasData.shape,unmappedValue,dtype=outDtype)
+    matchPositions=np.clip(np.searchsorted(sortedOld,atlasData),0,len(sortedOld)-1)
+    isMatched=sortedOld[matchPositions]==atlasData
+    if unmappedValue is None:
+        return np.where(isMatched,sortedNew[matchPositions],atlasData.astype(outDtype))
+    return np.where(isMatched,sortedNew[matchPositions],np.asarray(unmappedValue,dtype=outDtype))
+
+
+def uniqueAtlasLabels(atlasIn, maxLookupSize=2**24):
+    """
+    Returns the labels present in an atlas, in ascending order.  Equivalent
+    to np.unique(atlasData).astype(int), but marks the labels present in a
+    lookup table rather than sorting the whole volume when the labels span a
+    modest range.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas.
+    maxLookupSize : int, optional
+        Largest label range for which a lookup table is used.  The default
+        is 2**24.
+
+    Returns
+    -------
+    uniqueLabels : numpy.ndarray
+        The labels present in the atlas, as int64.
+
+    """
+    import numpy as np
+
+    atlasData=_atlasArray(atlasIn)
+    if atlasData.size==0:
+        return np.zeros(0,dtype=np.int64)
+    dataMin=int(atlasData.min())
+    dataMax=int(atlasData.max())
+    if dataMin>=0 and dataMax<maxLookupSize:
+        isPresent=np.zeros(dataMax+1,dtype=bool)
+        isPresent[atlasData]=True
+        return np.flatnonzero(isPresent).astype(np.int64)
+    return np.unique(atlasData).astype(np.int64)
+
+
+def renumberAtlasContiguous(atlasIn):
+    """
+    Renumbers an atlas' labels to 0, 1, 2 ... in ascending order of the
+    original labels, as required for dipy's connectivity_matrix.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas to renumber.
+
+    Returns
+    -------
+    renumberedData : numpy.ndarray
+        The renumbered atlas, in the smallest suitable integer dtype.
+    uniqueLabels : numpy.ndarray
+        The original labels, such that uniqueLabels[newLabel] is the
+        original label of newLabel.
+
+    """
+    if hasattr(atlasIn,'dataobj'):
+        atlasData, uniqueLabels=loadLabelVolume(atlasIn)
+    else:
+        atlasData=_atlasArray(atlasIn)
+        uniqueLabels=uniqueAtlasLabels(atlasData)
+    #every voxel is mapped, so the output dtype only needs to hold the label indexes
+    return relabelAtlas(atlasData,uniqueLabels,unmappedValue=0), uniqueLabels
+
+
+def remapAtlasByCategories(atlasIn, lookupTable, categoryColumns, labelColumn='#No.', unmappedValue=None, renumberedAtlas=None):
+    """
+    Remaps an atlas to several categorical labeling schemes at once, e.g. to
+    the gross anatomy ('GrossAnat') and hemisphere ('Hemi') categories of
+    GrossAnatomyLookup.csv.  The atlas' voxel data is read once and renumbered
+    to contiguous label indexes, after which each scheme only requires a
+    lookup into a short per-label table.
+
+    Each output volume holds, for each voxel, the index of its label's
+    category within the corresponding category list, matching the
+    renumbering previously done per label with np.isin in the segmentation
+    notebooks.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas to remap.
+    lookupTable : pandas.DataFrame or str
+        Table (or path to a csv of the table) with a row per atlas label.
+    categoryColumns : str or list of str
+        The column(s) of lookupTable to remap to, e.g.
+        ['GrossAnat', 'Hemi', 'full_grossNames'].
+    labelColumn : str, optional
+        The column of lookupTable holding the atlas label numbers.  The
+        default is '#No.'.
+    unmappedValue : int, optional
+        Value given to voxels whose label has no row in lookupTable.  The
+        default is None, in which case such labels raise a ValueError.
+    renumberedAtlas : tuple, optional
+        The output of renumberAtlasContiguous(atlasIn), if already computed,
+        in which case atlasIn isn't renumbered again.  The default is None.
+
+    Returns
+    -------
+    remappedVolumes : dict
+        {column: remapped volume} for each of categoryColumns, each in the
+        smallest suitable integer dtype.
+    categoryLists : dict
+        {column: lookupTable[column].unique()} for each of categoryColumns,
+        such that categoryLists[column][value] names the category of value
+        in remappedVolumes[column].
+
+    """
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(lookupTable, str):
+        lookupTable=pd.read_csv(lookupTable)
+    if isinstance(categoryColumns, str):
+        categoryColumns=[categoryColumns]
+
+    #the only pass over the voxel data
+    if renumberedAtlas is None:
+        renumberedAtlas=renumberAtlasContiguous(atlasIn)
+    labelIndexes, uniqueLabels=renumberedAtlas
+
+    #the first row of each label is used, as with the per-label loops
+    tableLabels=lookupTable[labelColumn].to_numpy().astype(np.int64)
+    firstRows=pd.Series(np.arange(len(tableLabels))).groupby(tableLabels).first()
+    labelRows=firstRows.reindex(uniqueLabels).to_numpy()
+    isUnmapped=np.isnan(labelRows)
+    if np.any(isUnmapped) and unmappedValue is None:
+        raise ValueError('atlas labels %s are not in the lookup table' % str(uniqueLabels[isUnmapped].tolist()))
+    labelRows=np.where(isUnmapped,0,labelRows).astype(np.int64)
+
+    remappedVolumes={}
+    categoryLists={}
+    for iColumn in categoryColumns:
+        categoryList=lookupTable[iColumn].unique()
+        #position of each row's category within the category list
+        rowCodes=pd.Index(categoryList).get_indexer(lookupTable[iColumn])
+        labelCodes=rowCodes[labelRows]
+        if np.any(isUnmapped):
+            labelCodes=np.where(isUnmapped,unmappedValue,labelCodes)
+        labelCodes=labelCodes.astype(minimalIntegerDtype(labelCodes.min(),labelCodes.max()))
+        remappedVolumes[iColumn]=labelCodes[labelIndexes]
+        categoryLists[iColumn]=categoryList
+    return remappedVolumes, categoryLists
+
+
+def loadLabelVolume(atlasIn):
+    """
+    Loads an atlas' labels as an integer volume (uint16 where the labels
+    allow it, i.e. 0-65535, int32 otherwise, or int64 for labels beyond the
+    int32 range) rather than the float64 copy produced by get_fdata, along
+    with the labels present in it.  Both are kept on the image object, so
+    subsequent calls (including those made by the other functions of this
+    module) reuse them rather than reading and converting the data again.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or str
+        The atlas image, or a path to it.
+
+    Returns
+    -------
+    labelData : numpy.ndarray
+        The atlas labels.  As the array is shared between calls, it should
+        be copied before being modified.
+    uniqueLabels : numpy.ndarray
+        The labels present in the atlas, in ascending order, i.e.
+        np.unique(atlasImg.get_fdata()).astype(int)
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if isinstance(atlasIn, str):
+        atlasIn=nib.load(atlasIn)
+    cachedVolume=getattr(atlasIn,'_wimseLabelVolume',None)
+    #an image whose data has been replaced since the volume was cached is read again
+    if cachedVolume is not None and cachedVolume[0] is atlasIn.dataobj:
+        return cachedVolume[1], cachedVolume[2]
+
+    labelData=_atlasArray(np.asanyarray(atlasIn.dataobj))
+    if labelData.size==0 or (labelData.min()>=0 and labelData.max()<=np.iinfo(np.uint16).max):
+        labelDtype=np.uint16
+    elif labelData.min()>=np.iinfo(np.int32).min and labelData.max()<=np.iinfo(np.int32).max:
+        #negative labels or labels above 65535
+        labelDtype=np.int32
+    else:
+        labelDtype=np.int64
+    labelData=labelData.astype(labelDtype,copy=False)
+    uniqueLabels=uniqueAtlasLabels(labelData)
+    atlasIn._wimseLabelVolume=(atlasIn.dataobj,labelData,uniqueLabels)
+    return labelData, uniqueLabels
+
+
+def atlasLabelStats(atlasIn, affine=None, renumberedAtlas=None):
+    """
+    Computes summary statistics for every label of an atlas: its voxel
+    count, volume, centroid and bounding box.  Rather than building a table
+    with a row per voxel, each label's voxels are counted per slice along
+    each axis with np.bincount, which yields the counts, centroids and
+    bounding boxes from three passes over the label volume.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas.
+    affine : numpy.ndarray, optional
+        Voxel to world (mm) affine.  The default is the image's affine, or
+        the identity for arrays.
+    renumberedAtlas : tuple, optional
+        The output of renumberAtlasContiguous(atlasIn), if already computed,
+        in which case atlasIn isn't renumbered again.  The default is None.
+
+    Returns
+    -------
+    labelStats : pandas.DataFrame
+        Table indexed by label number ('Label Number') with the columns
+        'voxel count', 'volume (mm^3)', the voxel ('centroid i/j/k') and
+        world ('centroid x/y/z') centroids, and the inclusive voxel
+        ('min i' ... 'max k') and world ('min x' ... 'max z') bounding boxes.
+        World bounding boxes span voxel centers, as with
+        nib.affines.apply_affine of the voxel bounding box.
+
+    """
+    import itertools
+    import numpy as np
+    import pandas as pd
+
+    if affine is None:
+        affine=getattr(atlasIn,'affine',None)
+    if affine is None:
+        affine=np.eye(4)
+    if renumberedAtlas is None:
+        renumberedAtlas=renumberAtlasContiguous(atlasIn)
+    labelIndexes, uniqueLabels=renumberedAtlas
+    #nibabel loads volumes in Fortran order, which makes slicing the first axes slow
+    labelIndexes=np.ascontiguousarray(labelIndexes)
+    nLabels=len(uniqueLabels)
+
+    voxelCounts=np.zeros(nLabels,dtype=np.int64)
+    voxelCentroids=np.zeros((nLabels,3))
+    voxelMins=np.zeros((nLabels,3),dtype=np.int64)
+    voxelMaxs=np.zeros((nLabels,3),dtype=np.int64)
+    for iAxis in range(3):
+        #sliceCounts[position, label] is the number of voxels of the label in that slice
+        sliceCounts=np.zeros((labelIndexes.shape[iAxis],nLabels),dtype=np.int64)
+        for iSlice in range(labelIndexes.shape[iAxis]):
+            sliceCounts[iSlice]=np.bincount(labelIndexes[(slice(None),)*iAxis+(iSlice,)].reshape(-1),minlength=nLabels)
+        voxelCounts=sliceCounts.sum(axis=0)
+        positions=np.arange(labelIndexes.shape[iAxis])
+        voxelCentroids[:,iAxis]=np.dot(positions,sliceCounts)/np.maximum(voxelCounts,1)
+        isPresent=sliceCounts>0
+        voxelMins[:,iAxis]=np.argmax(isPresent,axis=0)
+        voxelMaxs[:,iAxis]=len(positions)-1-np.argmax(isPresent[::-1],axis=0)
+
+    worldCentroids=np.dot(voxelCentroids,affine[:3,:3].T)+affine[:3,3]
+    #the world extent of a (possibly rotated) box is found from its corners
+    worldCorners=np.stack([np.dot(np.where(iCorner,voxelMaxs,voxelMins),affine[:3,:3].T)+affine[:3,3] for iCorner in itertools.product([False,True],repeat=3)])
+    worldMins=worldCorners.min(axis=0)
+    worldMaxs=worldCorners.max(axis=0)
+    voxelVolume=np.abs(np.linalg.det(affine[:3,:3]))
+
+    labelStats=pd.DataFrame({'voxel count':voxelCounts,
+                             'volume (mm^3)':voxelCounts*voxelVolume},
+                            index=pd.Index(uniqueLabels,name='Label Number'))
+    for iAxis, voxelAxis in enumerate('ijk'):
+        labelStats['centroid '+voxelAxis]=voxelCentroids[:,iAxis]
+    for iAxis, worldAxis in enumerate('xyz'):
+        labelStats['centroid '+worldAxis]=worldCentroids[:,iAxis]
+    for iAxis, voxelAxis in enumerate('ijk'):
+        labelStats['min '+voxelAxis]=voxelMins[:,iAxis]
+        labelStats['max '+voxelAxis]=voxelMaxs[:,iAxis]
+    for iAxis, worldAxis in enumerate('xyz'):
+        labelStats['min '+worldAxis]=worldMins[:,iAxis]
+        labelStats['max '+worldAxis]=worldMaxs[:,iAxis]
+    return labelStats
+
+
+class AtlasLabelIndex():
+    """
+    Index of the voxels belonging to each label of an atlas, built once with
+    a single sort of the label volume.  Stored in compressed sparse row form:
+    the voxels of uniqueLabels[i] are the (sorted, flat) voxelIndexes
+    between offsets[i] and offsets[i+1].  Masks and coordinates for one or
+    several labels can then be obtained at a cost proportional to the size
+    of the labels, rather than with a comparison across the whole volume
+    (as with WMA_pyFuncs.multiROIrequestToMask).
+
+    Flat voxel indexes follow numpy's C order, i.e. they can be converted to
+    voxel coordinates with np.unravel_index(voxelIndexes, shape).
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas to index.
+    affine : numpy.ndarray, optional
+        Voxel to world (mm) affine used for mask images.  The default is the
+        image's affine.
+    """
+
+    def __init__(self, atlasIn, affine=None):
+        import numpy as np
+
+        if affine is None:
+            affine=getattr(atlasIn,'affine',None)
+        self.affine=affine
+        self.header=getattr(atlasIn,'header',None)
+        labelIndexes, self.uniqueLabels=renumberAtlasContiguous(atlasIn)
+        self.shape=labelIndexes.shape
+        flatLabelIndexes=labelIndexes.reshape(-1)
+        #a stable sort keeps each label's voxels in ascending flat order
+        self.voxelIndexes=np.argsort(flatLabelIndexes,kind='stable')
+        if len(flatLabelIndexes)<np.iinfo(np.int32).max:
+            self.voxelIndexes=self.voxelIndexes.astype(np.int32)
+        labelCounts=np.bincount(flatLabelIndexes,minlength=len(self.uniqueLabels))
+        self.offsets=np.concatenate([[0],np.cumsum(labelCounts)]).astype(np.int64)
+
+    def labelVoxelIndexes(self, labels):
+        """
+        Returns the sorted flat indexes of the voxels with any of the
+        specified labels.
+
+        Parameters
+        ----------
+        labels : int or list of int
+            The atlas label(s), e.g. roiNum from the notebook drop downs.
+            Labels not present in the atlas contribute no voxels.
+
+        Returns
+        -------
+        voxelIndexes : numpy.ndarray
+            Flat (C order) indexes of the voxels.
+
+        """
+        import numpy as np
+
+        labels=np.atleast_1d(np.asarray(labels,dtype=np.int64))
+        labelPositions=np.searchsorted(self.uniqueLabels,labels)
+        labelPositions=np.unique(labelPositions[np.logical_and(labelPositions<len(self.uniqueLabels),
+                                                               self.uniqueLabels[np.minimum(labelPositions,len(self.uniqueLabels)-1)]==labels)])
+        segments=[self.voxelIndexes[self.offsets[iPosition]:self.offsets[iPosition+1]] for iPosition in labelPositions]
+        if len(segments)==0:
+            return np.zeros(0,dtype=self.voxelIndexes.dtype)
+        if len(segments)==1:
+            return segments[0]
+        return np.sort(np.concatenate(segments))
+
+    def labelCoordinates(self, labels):
+        """
+        Returns the voxel coordinates of the voxels with any of the specified
+        labels.
+
+        Parameters
+        ----------
+        labels : int or list of int
+            The atlas label(s).
+
+        Returns
+        -------
+        voxelCoords : numpy.ndarray
+            N by 3 array of voxel (i, j, k) coordinates.
+
+        """
+        import numpy as np
+
+        return np.stack(np.unravel_index(self.labelVoxelIndexes(labels),self.shape),axis=1)
+
+    def labelMask(self, labels):
+        """
+        Returns a dense boolean mask of the voxels with any of the specified
+        labels.
+
+        Parameters
+        ----------
+        labels : int or list of int
+            The atlas label(s).
+
+        Returns
+        -------
+        labelMask : numpy.ndarray
+            Boolean array, the shape of the atlas.
+
+        """
+        import numpy as np
+
+        labelMask=np.zeros(self.shape,dtype=bool)
+        labelMask.reshape(-1)[self.labelVoxelIndexes(labels)]=True
+        return labelMask
+
+    def labelMaskImage(self, labels):
+        """
+        Returns a mask image of the voxels with any of the specified labels,
+        for use in place of WMA_pyFuncs.multiROIrequestToMask(atlasImg, labels)
+
+        Parameters
+        ----------
+        labels : int or list of int
+            The atlas label(s).
+
+        Returns
+        -------
+        maskImg : nibabel.Nifti1Image
+            Mask (0/1, uint8) with the atlas' affine.
+
+        """
+        import nibabel as nib
+        import numpy as np
+
+        maskImg=nib.Nifti1Image(self.labelMask(labels).astype(np.uint8),self.affine,self.header)
+        maskImg.set_data_dtype(np.uint8)
+        return maskImg
+
+
+def getAtlasLabelIndex(atlasImg):
+    """
+    Returns the AtlasLabelIndex of an atlas image, building it on the first
+    call and keeping it on the image object for subsequent calls (e.g. from
+    interactive plotting callbacks).
+
+    Parameters
+    ----------
+    atlasImg : nibabel.Nifti1Image
+        The atlas.
+
+    Returns
+    -------
+    labelIndex : AtlasLabelIndex
+        The index of the atlas' label voxels.
+
+    """
+    cachedIndex=getattr(atlasImg,'_wimseLabelIndex',None)
+    if cachedIndex is not None and cachedIndex[0] is atlasImg.dataobj:
+        return cachedIndex[1]
+    labelIndex=AtlasLabelIndex(atlasImg)
+    atlasImg._wimseLabelIndex=(atlasImg.dataobj,labelIndex)
+    return labelIndex
+
+
+def _blockView(volumeData, factor, padValue):
+    """
+    Pads a volume to a multiple of factor along each axis, and returns it
+    reshaped to (blocks along i, j, k, factor**3 voxels per block).
+    """
+    import numpy as np
+
+    paddedShape=[int(np.ceil(iDim/factor))*factor for iDim in volumeData.shape]
+    if list(volumeData.shape)!=paddedShape:
+        paddedData=np.full(paddedShape,padValue,dtype=volumeData.dtype)
+        paddedData[0:volumeData.shape[0],0:volumeData.shape[1],0:volumeData.shape[2]]=volumeData
+        volumeData=paddedData
+    blockShape=[iDim//factor for iDim in paddedShape]
+    blockData=volumeData.reshape(blockShape[0],factor,blockShape[1],factor,blockShape[2],factor)
+    return blockData.transpose(0,2,4,1,3,5).reshape(blockShape+[factor**3])
+
+
+def downsampleAffine(affine, factor):
+    """
+    Returns the affine of a volume downsampled by an integer factor, such
+    that each downsampled voxel is centered on the block of factor**3
+    original voxels it summarizes.
+
+    Parameters
+    ----------
+    affine : numpy.ndarray
+        4 by 4 voxel to world affine of the original volume.
+    factor : int
+        The downsampling factor.
+
+    Returns
+    -------
+    downsampledAffine : numpy.ndarray
+        4 by 4 voxel to world affine of the downsampled volume.
+
+    """
+    import numpy as np
+
+    blockToVoxel=np.diag([factor,factor,factor,1.0])
+    blockToVoxel[0:3,3]=(factor-1)/2.0
+    return np.dot(affine,blockToVoxel)
+
+
+def downsampleVolume(volumeIn, factor, isLabel):
+    """
+    Downsamples a volume by an integer factor.  Label volumes are pooled with
+    the mode of each block (ties go to the lower label), so that labels are
+    never blended into values which don't exist in the atlas; intensity
+    volumes are pooled with the mean of each block.  Volumes whose
+    dimensions aren't a multiple of factor are treated as if padded, with
+    the padding ignored.
+
+    Parameters
+    ----------
+    volumeIn : numpy.ndarray
+        3D volume.
+    factor : int
+        The downsampling factor, e.g. 2 or 4.
+    isLabel : bool
+        Whether the volume is a label volume (e.g. an atlas) or an intensity
+        volume (e.g. a T1).
+
+    Returns
+    -------
+    downsampledData : numpy.ndarray
+        The downsampled volume; the atlas' own labels and dtype for label
+        volumes, float32 for intensity volumes.
+
+    """
+    import numpy as np
+
+    factor=int(factor)
+    if not isLabel:
+        volumeIn=np.asarray(volumeIn,dtype=np.float32)
+        blockSums=_blockView(volumeIn,factor,0).sum(axis=-1,dtype=np.float64)
+        blockCounts=_blockView(np.ones(volumeIn.shape,dtype=np.uint8),factor,0).sum(axis=-1)
+        return (blockSums/blockCounts).astype(np.float32)
+
+    #pool contiguous label indexes, with the padding as an extra index
+    labelIndexes, uniqueLabels=renumberAtlasContiguous(volumeIn)
+    padIndex=len(uniqueLabels)
+    labelIndexes=labelIndexes.astype(minimalIntegerDtype(0,padIndex),copy=False)
+    blockData=_blockView(labelIndexes,factor,padIndex)
+    blockShape=blockData.shape[0:3]
+    blockData=np.sort(blockData.reshape(-1,factor**3),axis=1)
+    #length of the run of equal labels ending at each position of the sorted blocks
+    positions=np.arange(factor**3)
+    isRunStart=np.ones(blockData.shape,dtype=bool)
+    isRunStart[:,1:]=blockData[:,1:]!=blockData[:,:-1]
+    runStarts=np.maximum.accumulate(np.where(isRunStart,positions,0),axis=1)
+    runLengths=positions-runStarts+1
+    runLengths[blockData==padIndex]=0
+    modeIndexes=blockData[np.arange(len(blockData)),np.argmax(runLengths,axis=1)]
+    labelData=_atlasArray(volumeIn)
+    return uniqueLabels[modeIndexes].astype(labelData.dtype).reshape(blockShape)
+
+
+def buildImagePyramid(imgIn, isLabel, factors=(2,4), saveAlongside=False):
+    """
+    Precomputes downsampled versions of an image (see downsampleVolume),
+    e.g. for responsive interactive plotting of an atlas or T1.  The levels
+    are kept on the image object, so repeated requests are free.
+
+    Parameters
+    ----------
+    imgIn : nibabel.Nifti1Image or str
+        The image, or a path to it.
+    isLabel : bool
+        Whether the image is a label volume (mode pooling) or an intensity
+        volume (mean pooling).
+    factors : tuple of int, optional
+        The downsampling factors.  The default is (2,4).
+    saveAlongside : bool, optional
+        Whether to also save each level next to the original file, as
+        <name>_x<factor>.nii.gz.  Requires imgIn to be a path.  The default
+        is False.
+
+    Returns
+    -------
+    pyramid : dict
+        {factor: nibabel.Nifti1Image} for each of factors, plus the
+        original image under 1.  Each level's affine maps its voxels to the
+        centers of the blocks they summarize.
+
+    """
+    import os
+    import nibabel as nib
+    import numpy as np
+
+    imgPath=None
+    if isinstance(imgIn, str):
+        imgPath=imgIn
+        imgIn=nib.load(imgPath)
+    if saveAlongside and imgPath is None:
+        raise ValueError('saveAlongside requires the path of the image')
+
+    cachedPyramid=getattr(imgIn,'_wimsePyramid',None)
+    if cachedPyramid is None or cachedPyramid[0] is not imgIn.dataobj or cachedPyramid[1]!=isLabel:
+        cachedPyramid=(imgIn.dataobj,isLabel,{1:imgIn})
+        imgIn._wimsePyramid=cachedPyramid
+    pyramid=cachedPyramid[2]
+
+    for iFactor in factors:
+        if iFactor not in pyramid:
+            if isLabel:
+                volumeData=loadLabelVolume(imgIn)[0]
+            else:
+                volumeData=np.asanyarray(imgIn.dataobj)
+            downsampledData=downsampleVolume(volumeData,iFactor,isLabel)
+            levelImg=nib.Nifti1Image(downsampledData,downsampleAffine(imgIn.affine,iFactor),imgIn.header)
+            levelImg.set_data_dtype(downsampledData.dtype)
+            pyramid[iFactor]=levelImg
+        if saveAlongside:
+            imgName=os.path.basename(imgPath)
+            for iExtension in ['.nii.gz','.nii']:
+                if imgName.endswith(iExtension):
+                    imgName=imgName[0:-len(iExtension)]
+                    break
+            nib.save(pyramid[iFactor],os.path.join(os.path.dirname(imgPath),'%s_x%i.nii.gz' % (imgName,iFactor)))
+    return dict([(iFactor,pyramid[iFactor]) for iFactor in [1]+list(factors)])
+
+
+def _writeGzipParallel(dataBytes, outPath, compressLevel=1, nThreads=None, chunkSize=4):
+    """
+    Writes bytes to a single member gzip file, deflating chunks of the data
+    in parallel threads (zlib releases the GIL) and joining the resulting
+    deflate blocks, as pigz does.
+
+    Parameters
+    ----------
+    dataBytes : bytes
+        The (uncompressed) file content.
+    outPath : str
+        Path to the output .gz file.
+    compressLevel : int, optional
+        zlib compression level.  The default is 1, as with nibabel.
+    nThreads : int, optional
+        Number of threads.  The default is os.cpu_count().
+    chunkSize : float, optional
+        Size (in MB) of the independently deflated chunks.  The default is 4.
+
+    """
+    import os
+    import struct
+    import time
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    if nThreads is None:
+        nThreads=os.cpu_count() or 1
+    dataView=memoryview(dataBytes)
+    chunkBytes=int(chunkSize*1024*1024)
+    chunkStarts=list(range(0,len(dataView),chunkBytes)) or [0]
+
+    def deflateChunk(chunkNumber):
+        compressor=zlib.compressobj(compressLevel,zlib.DEFLATED,-15)
+        chunkData=dataView[chunkStarts[chunkNumber]:chunkStarts[chunkNumber]+chunkBytes]
+        #all but the last chunk end on a byte boundary without closing the stream
+        if chunkNumber==len(chunkStarts)-1:
+            return compressor.compress(chunkData)+compressor.flush(zlib.Z_FINISH)
+        return compressor.compress(chunkData)+compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        deflatedChunks=list(executor.map(deflateChunk,range(len(chunkStarts))))
+
+    temporaryPath=outPath+'.%i.tmp' % os.getpid()
+    with open(temporaryPath,'wb') as outFile:
+        #gzip header: magic, deflate, no flags, modification time, no extra flags, unknown OS
+        outFile.write(b'\x1f\x8b\x08\x00'+struct.pack('<I',int(time.time()))+b'\x00\xff')
+        for iChunk in deflatedChunks:
+            outFile.write(iChunk)
+        outFile.write(struct.pack('<II',zlib.crc32(dataView)&0xffffffff,len(dataView)&0xffffffff))
+    os.replace(temporaryPath,outPath)
+
+
+def saveDerivedImage(outPath, inputPaths, parameters, imgOut, nThreads=None):
+    """
+    Saves an image derived from other files (e.g. a renumbered atlas),
+    skipping the write when the existing file was already derived from the
+    same inputs, with the same parameters and content.  A sidecar
+    (<outPath>.json) records the hashes of the inputs, the parameters and
+    the image data, along with the size and modification time of the
+    written file.  When a write is needed, .nii paths are written
+    uncompressed and .nii.gz paths are deflated in parallel threads.
+
+    Parameters
+    ----------
+    outPath : str
+        Path to the output image (.nii or .nii.gz).
+    inputPaths : str or list of str
+        Path(s) of the files the image is derived from.
+    parameters : object
+        The parameters of the derivation (e.g. a dict), hashed with
+        WiMSE_cacheFuncs.hashParameters.
+    imgOut : nibabel.Nifti1Image or callable
+        The image, or a function returning it, in which case the image is
+        only computed when the existing file is out of date.  For a
+        function, the parameters must fully determine the output, as the
+        image data can't be checked beforehand.
+    nThreads : int, optional
+        Number of threads used for compression.  The default is
+        os.cpu_count().
+
+    Returns
+    -------
+    wasWritten : bool
+        False if the existing file was up to date and left untouched.
+
+    """
+    import json
+    import os
+    import numpy as np
+    from . import WiMSE_cacheFuncs
+
+    sidecarPath=outPath+'.json'
+    previousRecord={}
+    if os.path.exists(sidecarPath):
+        try:
+            with open(sidecarPath,'r') as sidecarFile:
+                previousRecord=json.load(sidecarFile)
+        except ValueError:
+            previousRecord={}
+
+    #unchanged inputs (by size and modification time) aren't re-read
+    inputHash, inputFileHashes=WiMSE_cacheFuncs.hashFiles(inputPaths,knownHashes=previousRecord.get('inputFiles',{}))
+    currentRecord={'inputHash':inputHash,
+                   'inputFiles':inputFileHashes,
+                   'parameterHash':WiMSE_cacheFuncs.hashParameters(parameters)}
+    if not callable(imgOut):
+        #much cheaper than compressing the data
+        currentRecord['dataHash']=WiMSE_cacheFuncs.hashParameters((np.asanyarray(imgOut.dataobj),imgOut.affine,imgOut.header.binaryblock))
+
+    isCurrent=os.path.exists(outPath) and \
+        all([previousRecord.get(iKey)==currentRecord[iKey] for iKey in ['inputHash','parameterHash']]) and \
+        previousRecord.get('dataHash')==currentRecord.get('dataHash',previousRecord.get('dataHash')) and \
+        previousRecord.get('outputFingerprint')==WiMSE_cacheFuncs.fileFingerprint(outPath)
+    if isCurrent:
+        return False
+
+    if callable(imgOut):
+        imgOut=imgOut()
+        currentRecord['dataHash']=WiMSE_cacheFuncs.hashParameters((np.asanyarray(imgOut.dataobj),imgOut.affine,imgOut.header.binaryblock))
+    if outPath.endswith('.gz'):
+        _writeGzipParallel(imgOut.to_bytes(),outPath,nThreads=nThreads)
+    else:
+        imgOut.to_filename(outPath)
+
+    currentRecord['outputFingerprint']=WiMSE_cacheFuncs.fileFingerprint(outPath)
+    with open(sidecarPath,'w') as sidecarFile:
+        json.dump(currentRecord,sidecarFile,indent=1)
+    return True
+
+
+def atlasLabelAdjacency(atlasIn, affine=None):
+    """
+    Finds which labels of an atlas touch, how many voxel faces they share,
+    and where.  Each voxel is compared with its neighbor along each axis
+    (i.e. its 6-neighborhood, as each face is shared by two voxels) with
+    whole-volume array comparisons, and the differing pairs are grouped by
+    label pair.
+
+    Parameters
+    ----------
+    atlasIn : nibabel.Nifti1Image or numpy.ndarray
+        The atlas.
+    affine : numpy.ndarray, optional
+        Voxel to world (mm) affine.  The default is the image's affine, or
+        the identity for arrays.
+
+    Returns
+    -------
+    adjacencyTable : pandas.DataFrame
+        Table indexed by ('Label Number', 'Neighbor Label'), with a row for
+        each direction of each touching pair, so that the neighbors of a
+        label are adjacencyTable.loc[label].  Columns are 'face count' (the
+        number of shared voxel faces) and the inclusive voxel ('min i' ...
+        'max k') and world ('min x' ... 'max z') bounding box of the voxels
+        of either label along the contact.
+
+    """
+    import itertools
+    import numpy as np
+    import pandas as pd
+
+    if affine is None:
+        affine=getattr(atlasIn,'affine',None)
+    if affine is None:
+        affine=np.eye(4)
+    labelIndexes, uniqueLabels=renumberAtlasContiguous(atlasIn)
+    labelIndexes=np.ascontiguousarray(labelIndexes)
+    nLabels=len(uniqueLabels)
+    volumeShape=labelIndexes.shape
+
+    pairCodes=[]
+    faceFlatIndexes=[]
+    faceAxes=[]
+    for iAxis in range(3):
+        lowerVoxels=labelIndexes[(slice(None),)*iAxis+(slice(0,-1),)]
+        upperVoxels=labelIndexes[(slice(None),)*iAxis+(slice(1,None),)]
+        #coordinates of the lower voxel of each differing face
+        faceCoords=np.nonzero(lowerVoxels!=upperVoxels)
+        lowerLabels=lowerVoxels[faceCoords].astype(np.int64)
+        upperLabels=upperVoxels[faceCoords].astype(np.int64)
+        pairCodes.append(np.minimum(lowerLabels,upperLabels)*nLabels+np.maximum(lowerLabels,upperLabels))
+        faceFlatIndexes.append(np.ravel_multi_index(faceCoords,volumeShape))
+        faceAxes.append(np.full(len(lowerLabels),iAxis,dtype=np.int8))
+    pairCodes=np.concatenate(pairCodes)
+    faceFlatIndexes=np.concatenate(faceFlatIndexes)
+    faceAxes=np.concatenate(faceAxes)
+
+    #group the faces by label pair
+    faceOrder=np.argsort(pairCodes,kind='stable')
+    pairCodes=pairCodes[faceOrder]
+    uniquePairCodes, pairStarts, faceCounts=np.unique(pairCodes,return_index=True,return_counts=True)
+    lowerCoords=np.stack(np.unravel_index(faceFlatIndexes[faceOrder],volumeShape),axis=1)
+    #the other voxel of each face is one step along the face's axis
+    upperCoords=lowerCoords+np.eye(3,dtype=lowerCoords.dtype)[faceAxes[faceOrder]]
+    if len(uniquePairCodes)>0:
+        voxelMins=np.minimum.reduceat(lowerCoords,pairStarts,axis=0)
+        voxelMaxs=np.maximum.reduceat(upperCoords,pairStarts,axis=0)
+    else:
+        voxelMins=np.zeros((0,3),dtype=np.int64)
+        voxelMaxs=np.zeros((0,3),dtype=np.int64)
+    worldCorners=np.stack([np.dot(np.where(iCorner,voxelMaxs,voxelMins),affine[:3,:3].T)+affine[:3,3] for iCorner in itertools.product([False,True],repeat=3)])
+    worldMins=worldCorners.min(axis=0)
+    worldMaxs=worldCorners.max(axis=0)
+
+    #list each pair in both directions
+    firstLabels=uniqueLabels[uniquePairCodes//max(nLabels,1)]
+    secondLabels=uniqueLabels[uniquePairCodes%max(nLabels,1)]
+    pairColumns={'face count':faceCounts}
+    for iAxis, voxelAxis in enumerate('ijk'):
+        pairColumns['min '+voxelAxis]=voxelMins[:,iAxis]
+        pairColumns['max '+voxelAxis]=voxelMaxs[:,iAxis]
+    for iAxis, worldAxis in enumerate('xyz'):
+        pairColumns['min '+worldAxis]=worldMins[:,iAxis]
+        pairColumns['max '+worldAxis]=worldMaxs[:,iAxis]
+    adjacencyTable=pd.DataFrame(dict([(iColumn,np.concatenate([iValues,iValues])) for iColumn, iValues in pairColumns.items()]),
+                                index=pd.MultiIndex.from_arrays([np.concatenate([firstLabels,secondLabels]),np.concatenate([secondLabels,firstLabels])],
+                                                                names=['Label Number','Neighbor Label']))
+    return adjacencyTable.sort_index()
+
+
+def getAtlasLabelAdjacency(atlasImg):
+    """
+    Returns atlasLabelAdjacency(atlasImg), computing it on the first call
+    and keeping it on the image object for subsequent calls.
+
+    Parameters
+    ----------
+    atlasImg : nibabel.Nifti1Image
+        The atlas.
+
+    Returns
+    -------
+    adjacencyTable : pandas.DataFrame
+        See atlasLabelAdjacency.
+
+    """
+    cachedAdjacency=getattr(atlasImg,'_wimseLabelAdjacency',None)
+    if cachedAdjacency is not None and cachedAdjacency[0] is atlasImg.dataobj:
+        return cachedAdjacency[1]
+    adjacencyTable=atlasLabelAdjacency(atlasImg)
+    atlasImg._wimseLabelAdjacency=(atlasImg.dataobj,adjacencyTable)
+    return adjacencyTable
+
+
+def prepareSubjectAtlas(subjectID, atlasPath, lookupPath, subjectDir, categoryColumns=None):
+    """
+    Prepares one subject's atlas as in the segmentation notebooks, saving
+    into subjectDir:
+        renumberedAtlas.nii.gz : labels renumbered to 0, 1, 2 ...
+        <column>Atlas.nii.gz : one categorical volume per categoryColumns
+        labelStats.csv : atlasLabelStats of the atlas
+        categoryLists.json : {column: category names}, plus the original
+            labels of the renumbered atlas under 'uniqueAtlasEntries'
+    A record of the inputs' hashes and the parameters (preparation.json) is
+    kept alongside, so that an unchanged subject is skipped when prepared
+    again.
+
+    Parameters
+    ----------
+    subjectID : str
+        The subject's identifier, for reporting.
+    atlasPath : str
+        Path to the subject's atlas, e.g. its parc.nii.gz
+    lookupPath : str
+        Path to a lookup table with a '#No.' column and the categorical
+        columns, e.g. GrossAnatomyLookup.csv.  'full_grossNames' is derived
+        from 'Hemi' and 'GrossAnat' (as in the notebooks) when the table
+        doesn't hold it.
+    subjectDir : str
+        Output directory for the subject.
+    categoryColumns : list of str, optional
+        Columns to produce categorical volumes for.  The default is None,
+        i.e. ['GrossAnat','Hemi','full_grossNames'].
+
+    Returns
+    -------
+    subjectReport : dict
+        The subject, whether the cached outputs were reused, the time taken
+        in seconds and the paths of the outputs.
+
+    """
+    import json
+    import os
+    import time
+    import nibabel as nib
+    import pandas as pd
+    from . import WiMSE_cacheFuncs
+
+    if categoryColumns is None:
+        categoryColumns=['GrossAnat','Hemi','full_grossNames']
+    startTime=time.perf_counter()
+    os.makedirs(subjectDir,exist_ok=True)
+    outputPaths={'renumberedAtlas':os.path.join(subjectDir,'renumberedAtlas.nii.gz'),
+                 'labelStats':os.path.join(subjectDir,'labelStats.csv'),
+                 'categoryLists':os.path.join(subjectDir,'categoryLists.json')}
+    for iColumn in categoryColumns:
+        outputPaths[iColumn]=os.path.join(subjectDir,'%sAtlas.nii.gz' % iColumn)
+
+    recordPath=os.path.join(subjectDir,'preparation.json')
+    previousRecord={}
+    if os.path.exists(recordPath):
+        with open(recordPath,'r') as recordFile:
+            previousRecord=json.load(recordFile)
+    inputHash, inputFileHashes=WiMSE_cacheFuncs.hashFiles([atlasPath,lookupPath],knownHashes=previousRecord.get('inputFiles',{}))
+    currentRecord={'inputHash':inputHash,
+                   'inputFiles':inputFileHashes,
+                   'parameterHash':WiMSE_cacheFuncs.hashParameters(list(categoryColumns))}
+    if previousRecord.get('inputHash')==inputHash and previousRecord.get('parameterHash')==currentRecord['parameterHash'] and \
+            all([os.path.exists(iPath) for iPath in outputPaths.values()]):
+        return {'subject':subjectID,'cached':True,'seconds':time.perf_counter()-startTime,'outputs':outputPaths}
+
+    atlasImg=nib.load(atlasPath)
+    lookupTable=pd.read_csv(lookupPath)
+    if 'full_grossNames' in categoryColumns and 'full_grossNames' not in lookupTable.columns:
+        lookupTable['full_grossNames']=lookupTable['Hemi'].str.cat(lookupTable['GrossAnat'],sep="_")
+
+    #renumbered once, for all of the outputs
+    renumberedAtlas=renumberAtlasContiguous(atlasImg)
+    renumberedData, uniqueLabels=renumberedAtlas
+    remappedVolumes, categoryLists=remapAtlasByCategories(atlasImg,lookupTable,categoryColumns,renumberedAtlas=renumberedAtlas)
+    #the source header's dtype would otherwise be kept, rather than the compact one of the data
+    renumberedImg=nib.Nifti1Image(renumberedData,atlasImg.affine,atlasImg.header)
+    renumberedImg.set_data_dtype(renumberedData.dtype)
+    #processes already run in parallel, so each compresses on a single thread
+    saveDerivedImage(outputPaths['renumberedAtlas'],[atlasPath],'renumberedAtlas',renumberedImg,nThreads=1)
+    for iColumn in categoryColumns:
+        remappedImg=nib.Nifti1Image(remappedVolumes[iColumn],atlasImg.affine,atlasImg.header)
+        remappedImg.set_data_dtype(remappedVolumes[iColumn].dtype)
+        saveDerivedImage(outputPaths[iColumn],[atlasPath,lookupPath],iColumn,remappedImg,nThreads=1)
+    atlasLabelStats(atlasImg,renumberedAtlas=renumberedAtlas).to_csv(outputPaths['labelStats'])
+    categoryRecord=dict([(iColumn,[str(iCategory) for iCategory in categoryLists[iColumn]]) for iColumn in categoryColumns])
+    categoryRecord['uniqueAtlasEntries']=uniqueLabels.tolist()
+    with open(outputPaths['categoryLists'],'w') as categoryFile:
+        json.dump(categoryRecord,categoryFile,indent=1)
+
+    with open(recordPath,'w') as recordFile:
+        json.dump(currentRecord,recordFile,indent=1)
+    return {'subject':subjectID,'cached':False,'seconds':time.perf_counter()-startTime,'outputs':outputPaths}
+
+
+def prepareAtlases(manifest, outputDir, categoryColumns=None, nWorkers=None, verbose=True):
+    """
+    Prepares the atlases of many subjects (see prepareSubjectAtlas) with a
+    pool of processes, one subject per task.  Each subject's outputs are
+    written to outputDir/<subject>/, where they are reused by later runs as
+    long as the subject's inputs are unchanged.
+
+    Parameters
+    ----------
+    manifest : str or pandas.DataFrame or list of dict
+        Table (or path to a csv of the table) with a row per subject and the
+        columns 'subject', 'atlasPath' and 'lookupPath'.
+    outputDir : str
+        Directory under which each subject's directory is created.
+    categoryColumns : list of str, optional
+        Columns of the lookup tables to produce categorical volumes for.
+        The default is None, i.e. ['GrossAnat','Hemi','full_grossNames'].
+    nWorkers : int, optional
+        Number of processes.  The default is the number of available cpus.
+    verbose : bool, optional
+        Whether to print progress and per-subject timing.  The default is
+        True.
+
+    Returns
+    -------
+    preparationReport : list of dict
+        One dictionary per subject, in manifest order, with the subject,
+        whether cached outputs were reused, the time taken in seconds and
+        the output paths, or the error message under 'error' if the
+        subject failed.
+
+    """
+    import os
+    import time
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if isinstance(manifest, str):
+        manifest=pd.read_csv(manifest)
+    manifest=pd.DataFrame(manifest)
+    if nWorkers is None:
+        nWorkers=os.cpu_count() or 1
+
+    startTime=time.perf_counter()
+    preparationReport=[None]*len(manifest)
+    with ProcessPoolExecutor(max_workers=max(min(nWorkers,len(manifest)),1)) as executor:
+        subjectFutures={}
+        for iRow, iSubject in enumerate(manifest.itertuples(index=False)):
+            subjectDir=os.path.join(outputDir,str(iSubject.subject))
+            subjectFutures[executor.submit(prepareSubjectAtlas,str(iSubject.subject),iSubject.atlasPath,
+                                           iSubject.lookupPath,subjectDir,categoryColumns)]=iRow
+        for iDone, iFuture in enumerate(as_completed(subjectFutures)):
+            iRow=subjectFutures[iFuture]
+            try:
+                preparationReport[iRow]=iFuture.result()
+            except Exception as subjectError:
+                #one bad subject shouldn't discard the rest of the batch
+                preparationReport[iRow]={'subject':str(manifest['subject'].iloc[iRow]),'error':repr(subjectError)}
+            if verbose:
+                subjectReport=preparationReport[iRow]
+                if 'error' in subjectReport:
+                    print('[%i/%i] %s failed: %s' % (iDone+1,len(manifest),subjectReport['subject'],subjectReport['error']))
+                else:
+                    print('[%i/%i] %s %.2f s%s' % (iDone+1,len(manifest),subjectReport['subject'],subjectReport['seconds'],
+                                                   ' (cached)' if subjectReport['cached'] else ''))
+    if verbose:
+        print('prepared %i subjects in %.2f s' % (len(manifest),time.perf_counter()-startTime))
+    return preparationReport
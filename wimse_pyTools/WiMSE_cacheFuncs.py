@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for identifying input files by their content, and for caching
+objects derived from them (e.g. concatenated tractograms, connectivity
+groupings, relabeled atlases) on disk, so that repeated notebook runs can
+reuse them rather than recomputing them.
+"""
+
+
+def hashFile(filePath, chunkSize=16):
+    """
+    Computes the sha256 hash of a file's content, reading it in chunks.
+
+    Parameters
+    ----------
+    filePath : str
+        Path to the file.
+    chunkSize : float, optional
+        Size (in MB) of each read.  The default is 16.
+
+    Returns
+    -------
+    fileHash : str
+        Hexadecimal sha256 digest of the file's content.
+
+    """
+    import hashlib
+
+    hasher=hashlib.sha256()
+    with open(filePath,'rb') as fileIn:
+        for chunk in iter(lambda: fileIn.read(int(chunkSize*1024*1024)), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def fileFingerprint(filePath):
+    """
+    Returns a cheap fingerprint of a file (its size and modification time),
+    used to decide whether a previously computed content hash can be reused.
+
+    Parameters
+    ----------
+    filePath : str
+        Path to the file.
+
+    Returns
+    -------
+    fingerprint : list
+        [size in bytes, modification time in nanoseconds]
+
+    """
+    import os
+
+    fileStat=os.stat(filePath)
+    return [int(fileStat.st_size), int(fileStat.st_mtime_ns)]
+
+
+def hashFiles(filePaths, knownHashes=None):
+    """
+    Computes a single content hash for an ordered list of files.
+
+    Parameters
+    ----------
+    filePaths : str or list of str
+        Path(s) to the files.
+    knownHashes : dict, optional
+        Previously computed {absolute path: [fingerprint, hash]} entries, as
+        returned in the second output.  A file whose fingerprint (size and
+        modification time) is unchanged is not read again.
+
+    Returns
+    -------
+    combinedHash : str
+        Hexadecimal sha256 digest identifying the content of all of the
+        files, in order.
+    fileHashes : dict
+        {absolute path: [fingerprint, hash]} for each input file, suitable for
+        passing back in as knownHashes.
+
+    """
+    import hashlib
+    import os
+
+    if isinstance(filePaths, str):
+        filePaths=[filePaths]
+    if knownHashes is None:
+        knownHashes={}
+
+    combinedHasher=hashlib.sha256()
+    fileHashes={}
+    for iPath in filePaths:
+        absolutePath=os.path.abspath(iPath)
+        currentFingerprint=fileFingerprint(absolutePath)
+        if absolutePath in knownHashes and list(knownHashes[absolutePath][0])==currentFingerprint:
+            currentHash=knownHashes[absolutePath][1]
+        else:
+            currentHash=hashFile(absolutePath)
+        fileHashes[absolutePath]=[currentFingerprint,currentHash]
+        combinedHasher.update(currentHash.encode('ascii'))
+    return combinedHasher.hexdigest(), fileHashes
+
+
+def defaultCacheDir():
+    """
+    Returns the directory used by cachedCall when none is specified: the
+    WIMSE_CACHE_DIR environment variable if it is set, otherwise
+    ~/.cache/wimse
+
+    Returns
+    -------
+    cacheDir : str
+        Path to the cache directory.
+
+    """
+    import os
+
+    return os.environ.get('WIMSE_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.cache','wimse'))
+
+
+def hashParameters(params):
+    """
+    Computes a deterministic hash of (possibly nested) call parameters.
+    Dictionaries are hashed independently of key order, numpy arrays by
+    their dtype, shape and content, functions by their name, and other
+    objects (e.g. ArraySequences, MultiFileTractograms) by their attributes.
+
+    Parameters
+    ----------
+    params : object
+        Parameters to hash, e.g. a tuple of positional arguments or a dict
+        of keyword arguments.
+
+    Returns
+    -------
+    paramHash : str
+        Hexadecimal sha256 digest.
+
+    """
+    import hashlib
+    import re
+    import numpy as np
+
+    hasher=hashlib.sha256()
+    #guards against objects which refer back to themselves
+    visitedIds=set()
+
+    def updateHash(item):
+        if id(item) in visitedIds:
+            hasher.update(b'visited')
+            return
+        if isinstance(item, dict):
+            hasher.update(b'dict')
+            for iKey in sorted(item.keys(), key=repr):
+                updateHash(iKey)
+                updateHash(item[iKey])
+        elif isinstance(item, (list, tuple)):
+            hasher.update(type(item).__name__.encode('ascii'))
+            for iItem in item:
+                updateHash(iItem)
+        elif isinstance(item, np.ndarray):
+            hasher.update(('ndarray%s%s' % (item.dtype.str, item.shape)).encode('ascii'))
+            if item.flags.f_contiguous and not item.flags.c_contiguous:
+                #e.g. volumes loaded by nibabel; hashing the transposed view avoids a reordering copy
+                hasher.update(b'F')
+                hasher.update(item.T.tobytes())
+            else:
+                hasher.update(np.ascontiguousarray(item).tobytes())
+        elif callable(item) and hasattr(item,'__qualname__'):
+            hasher.update(('%s.%s' % (getattr(item,'__module__',''),item.__qualname__)).encode('utf-8'))
+        elif hasattr(item,'__dict__'):
+            #the default repr of an object includes its memory address
+            visitedIds.add(id(item))
+            hasher.update(type(item).__name__.encode('utf-8'))
+            updateHash(vars(item))
+        else:
+            #drop any memory address from the repr, e.g. for locks
+            hasher.update(re.sub(' at 0x[0-9a-fA-F]+','',repr(item)).encode('utf-8'))
+
+    updateHash(params)
+    return hasher.hexdigest()
+
+
+def _loadKnownHashes(cacheDir):
+    """
+    Loads the {path: [fingerprint, hash]} record of previously hashed input
+    files kept in the cache directory.
+    """
+    import json
+    import os
+
+    knownHashesPath=os.path.join(cacheDir,'fileHashes.json')
+    if os.path.exists(knownHashesPath):
+        try:
+            with open(knownHashesPath,'r') as knownHashesFile:
+                return json.load(knownHashesFile)
+        except ValueError:
+            #a damaged record just means the files get hashed again
+            return {}
+    return {}
+
+
+def _saveKnownHashes(cacheDir, knownHashes):
+    """
+    Saves the {path: [fingerprint, hash]} record of hashed input files.
+    """
+    import json
+    import os
+
+    knownHashesPath=os.path.join(cacheDir,'fileHashes.json')
+    temporaryPath=knownHashesPath+'.%i.tmp' % os.getpid()
+    with open(temporaryPath,'w') as knownHashesFile:
+        json.dump(knownHashes,knownHashesFile)
+    os.replace(temporaryPath,knownHashesPath)
+
+
+def pruneCache(cacheDir=None, maxSizeMB=10240):
+    """
+    Deletes the least recently used cache entries until the total size of
+    the cache is below maxSizeMB.
+
+    Parameters
+    ----------
+    cacheDir : str, optional
+        Path to the cache directory.  The default is defaultCacheDir().
+    maxSizeMB : float, optional
+        Maximum total size of the cache entries, in MB.  The default is
+        10240 (10 GB).
+
+    Returns
+    -------
+    removedEntries : list of str
+        Paths of the deleted entries.
+
+    """
+    import glob
+    import os
+
+    if cacheDir is None:
+        cacheDir=defaultCacheDir()
+    entryPaths=glob.glob(os.path.join(cacheDir,'*.pkl'))
+    #cachedCall touches entries when they are used, so mtime orders by recency
+    entryStats=sorted([(os.stat(iPath).st_mtime_ns,os.stat(iPath).st_size,iPath) for iPath in entryPaths])
+    totalBytes=sum([iStat[1] for iStat in entryStats])
+    removedEntries=[]
+    for entryTime, entryBytes, entryPath in entryStats:
+        if totalBytes<=maxSizeMB*1024*1024:
+            break
+        os.remove(entryPath)
+        totalBytes=totalBytes-entryBytes
+        removedEntries.append(entryPath)
+    return removedEntries
+
+
+def cachedCall(function, inputPaths, *args, cacheDir=None, maxSizeMB=10240, fileDerivedArgs=None, **kwargs):
+    """
+    Calls function(*args, **kwargs), or returns its previously stored output.
+    Outputs are stored in the cache directory, keyed by the content hash of
+    the input files, the function's name and the call parameters, so a
+    change to any of them automatically results in a new computation.  The
+    least recently used entries are removed once the cache exceeds
+    maxSizeMB.
+
+    For example, the connectivity matrix of the segmentation notebooks could
+    be obtained with
+
+        M, grouping=cachedCall(utils.connectivity_matrix, [tractogramPath, atlasPath],
+                               sourceTractogram.streamlines, atlasImg.affine,
+                               label_volume=relabeledAtlas, return_mapping=True,
+                               mapping_as_streamlines=False,
+                               fileDerivedArgs=[0])
+
+    Arguments are hashed by their content (see hashParameters), which for
+    large arrays (e.g. the streamlines above, possibly memory mapped) means
+    reading all of their data on every call.  Arguments which were loaded
+    from the files in inputPaths are already identified by those files'
+    hashes (which are only recomputed when a file's size or modification
+    time changes), so they should be listed in fileDerivedArgs, which leaves
+    them out of the key and keeps cache hits cheap.
+
+    Parameters
+    ----------
+    function : callable
+        The function to call.  Its output must be picklable.
+    inputPaths : str or list of str
+        Path(s) of the files the output is derived from.
+    *args
+        Positional arguments for the function.
+    cacheDir : str, optional
+        Path to the cache directory.  The default is defaultCacheDir().
+    maxSizeMB : float, optional
+        Maximum total size of the cache entries, in MB.  The default is
+        10240 (10 GB).
+    fileDerivedArgs : list of int or str, optional
+        Positions (in args) and names (in kwargs) of the arguments loaded
+        from the files in inputPaths, which are keyed by the hash of those
+        files rather than by their content.  The default is None, i.e. all
+        arguments are hashed.
+    **kwargs
+        Keyword arguments for the function.
+
+    Returns
+    -------
+    output : object
+        The output of the function.
+
+    """
+    import os
+    import pickle
+
+    if cacheDir is None:
+        cacheDir=defaultCacheDir()
+    os.makedirs(cacheDir,exist_ok=True)
+
+    #files whose size and modification time haven't changed aren't re-read
+    knownHashes=_loadKnownHashes(cacheDir)
+    inputHash, inputFileHashes=hashFiles(inputPaths,knownHashes=knownHashes)
+    knownHashes.update(inputFileHashes)
+    _saveKnownHashes(cacheDir,knownHashes)
+
+    functionName='%s.%s' % (getattr(function,'__module__',''),getattr(function,'__qualname__',repr(function)))
+    if fileDerivedArgs is None:
+        fileDerivedArgs=[]
+    #arguments loaded from the input files are covered by inputHash
+    keyArgs=tuple(['fileDerivedArg' if iPosition in fileDerivedArgs else iArg for iPosition, iArg in enumerate(args)])
+    keyKwargs={iName:('fileDerivedArg' if iName in fileDerivedArgs else iValue) for iName, iValue in kwargs.items()}
+    cacheKey=hashParameters((inputHash,functionName,keyArgs,keyKwargs))
+    entryPath=os.path.join(cacheDir,cacheKey+'.pkl')
+
+    if os.path.exists(entryPath):
+        try:
+            with open(entryPath,'rb') as entryFile:
+                output=pickle.load(entryFile)
+            #mark the entry as recently used
+            os.utime(entryPath)
+            return output
+        except (EOFError, pickle.UnpicklingError):
+            #a damaged entry is simply recomputed
+            os.remove(entryPath)
+
+    output=function(*args,**kwargs)
+    #write to a temporary file first so that an interrupted write can't leave a damaged entry
+    temporaryPath=entryPath+'.%i.tmp' % os.getpid()
+    with open(temporaryPath,'wb') as entryFile:
+        pickle.dump(output,entryFile,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaryPath,entryPath)
+    pruneCache(cacheDir,maxSizeMB)
+    return output
+
+
+def clearCache(cacheDir=None):
+    """
+    Deletes every entry of the cache, along with the record of input hashes.
+
+    Parameters
+    ----------
+    cacheDir : str, optional
+        Path to the cache directory.  The default is defaultCacheDir().
+
+    """
+    import glob
+    import os
+
+    if cacheDir is None:
+        cacheDir=defaultCacheDir()
+    for iPath in glob.glob(os.path.join(cacheDir,'*.pkl'))+glob.glob(os.path.join(cacheDir,'fileHashes.json')):
+        os.remove(iPath)
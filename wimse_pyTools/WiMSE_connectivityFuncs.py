@@ -0,0 +1,761 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for assigning streamlines to the atlas labels at their endpoints
+and building connectivity matrices (and the streamline groupings behind
+them) from those assignments, as done with
+dipy.tracking.utils.connectivity_matrix throughout the WiMSE notebooks.
+"""
+
+
+def endpointVoxels(endpoints, affine, volumeShape=None):
+    """
+    Maps points (e.g. streamline endpoints) to the indexes of the voxels
+    containing them, in a single batched operation.  The mapping matches
+    dipy's (nearest voxel center, via the inverse of the affine).
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        (N, 3) points, in the space of the affine (e.g. RAS+ mm).
+    affine : numpy.ndarray
+        (4, 4) voxel to world affine of the volume.
+    volumeShape : tuple of int, optional
+        Shape of the volume.  If provided, points outside of the volume
+        raise an IndexError.
+
+    Returns
+    -------
+    voxelIndexes : numpy.ndarray
+        (N, 3) integer voxel indexes.  Points with NaN coordinates (the
+        endpoints of streamlines without nodes, see
+        WiMSE_tractFuncs.streamlineEndpoints) get -1 along every axis.
+
+    """
+    import numpy as np
+
+    inverseAffine=np.linalg.inv(np.asarray(affine,dtype=np.float64))
+    #adding .5 before truncating rounds to the nearest voxel center
+    voxelCoords=np.dot(np.asarray(endpoints).reshape(-1,3),inverseAffine[:3,:3].T)+(inverseAffine[:3,3]+.5)
+    hasCoords=np.all(np.isfinite(voxelCoords),axis=1)
+    if not np.all(hasCoords):
+        voxelCoords=voxelCoords[hasCoords]
+    if len(voxelCoords)>0 and voxelCoords.min().round(decimals=6)<0:
+        raise IndexError('streamline has points that map to negative voxel indices')
+    voxelIndexes=voxelCoords.astype(np.intp)
+    if volumeShape is not None and len(voxelIndexes)>0:
+        if np.any(voxelIndexes.max(axis=0)>=np.asarray(volumeShape[0:3])):
+            raise IndexError('streamline has points that map outside of the volume')
+    if len(voxelIndexes)==len(hasCoords):
+        return voxelIndexes
+    allIndexes=np.full((len(hasCoords),3),-1,dtype=np.intp)
+    allIndexes[hasCoords]=voxelIndexes
+    return allIndexes
+
+
+class StreamlineGrouping(object):
+    """
+    The streamlines behind each entry of a connectivity matrix, stored
+    compactly: the indexes of all streamlines in a single int32 array,
+    sorted by the (lower, higher) pair of labels at their endpoints (and,
+    within each pair, by direction, then in ascending order), along with an
+    offsets array marking where each pair starts.  Every pair, in either or both directions, is
+    therefore a contiguous slice (i.e. a view) of that array, found in
+    constant time, and 10M streamlines take 40 MB rather than the GBs of a
+    dict of Python lists.
+
+    Indexing with a (row, column) tuple, keys(), values() and items()
+    behave like dipy's mapping (with mapping_as_streamlines=False), so a
+    grouping can be used wherever the notebooks used that dict: for a
+    symmetric grouping only (lower, higher) keys hold streamlines, for a
+    directed one (start, end) keys do.  Absent entries yield an empty array.
+    Streamlines without nodes belong to no entry.
+    """
+
+    def __init__(self, endpointPositions, labelCount, symmetric=True):
+        """
+        Parameters
+        ----------
+        endpointPositions : numpy.ndarray
+            (2, N) row / column index (see labelPositions) of the first and
+            last node of each streamline, or -1 for the streamlines left out
+            of the grouping (i.e. those without nodes).
+        labelCount : int
+            Number of rows / columns of the connectivity matrix.
+        symmetric : bool, optional
+            Whether the grouping is keyed as a symmetric (the default) or a
+            directed connectivity matrix.
+        """
+        import numpy as np
+
+        endpointPositions=np.asarray(endpointPositions,dtype=np.int64).reshape(2,-1)
+        self.labelCount=int(labelCount)
+        self.symmetric=symmetric
+        #pair code of the (lower, higher) label pair, doubled and offset by one for reversed streamlines
+        lowerPositions=np.minimum(endpointPositions[0],endpointPositions[1])
+        higherPositions=np.maximum(endpointPositions[0],endpointPositions[1])
+        sortCodes=(lowerPositions*self.labelCount+higherPositions)*2+(endpointPositions[0]>endpointPositions[1])
+        #left out streamlines are sorted past the last pair, then dropped
+        codeCount=2*self.labelCount*self.labelCount
+        isExcluded=lowerPositions<0
+        if np.any(isExcluded):
+            sortCodes[isExcluded]=codeCount
+        self.streamlineCount=len(sortCodes)
+        codeCounts=np.bincount(sortCodes,minlength=codeCount+1)[0:codeCount]
+        self.offsets=np.concatenate(([0],np.cumsum(codeCounts))).astype(np.int64)
+        #a stable sort keeps each pair's streamlines in ascending order
+        self.streamlineIndexes=np.argsort(sortCodes,kind='stable')[0:self.offsets[-1]].astype(np.int32)
+
+    def _pairCode(self, row, column):
+        row, column=int(row), int(column)
+        if min(row,column)<0 or max(row,column)>=self.labelCount:
+            raise IndexError('label index out of range for grouping of %i labels' % self.labelCount)
+        return min(row,column)*self.labelCount+max(row,column)
+
+    def pairIndexes(self, row, column):
+        """
+        Returns the indexes of the streamlines connecting two labels, in
+        either direction, as a view.
+        """
+        pairCode=self._pairCode(row,column)
+        return self.streamlineIndexes[self.offsets[2*pairCode]:self.offsets[2*pairCode+2]]
+
+    def directedIndexes(self, startRow, endRow):
+        """
+        Returns the indexes of the streamlines running from one label (first
+        node) to another (last node), as a view.
+        """
+        pairCode=self._pairCode(startRow,endRow)
+        if int(startRow)<=int(endRow):
+            return self.streamlineIndexes[self.offsets[2*pairCode]:self.offsets[2*pairCode+1]]
+        return self.streamlineIndexes[self.offsets[2*pairCode+1]:self.offsets[2*pairCode+2]]
+
+    def labelIndexes(self, row):
+        """
+        Returns the indexes of all of the streamlines with an endpoint in a
+        label.  The pairs with higher labels form a single slice, those with
+        lower labels are gathered from one slice per label.
+        """
+        import numpy as np
+
+        row=int(row)
+        lowerPairs=[self.pairIndexes(iRow,row) for iRow in range(row)]
+        higherPairs=self.streamlineIndexes[self.offsets[2*(row*self.labelCount+row)]:self.offsets[2*(row*self.labelCount+self.labelCount)]]
+        return np.concatenate(lowerPairs+[higherPairs])
+
+    def unionIndexes(self, pairs, directed=False):
+        """
+        Returns the sorted indexes of the streamlines of several pairs of
+        labels, e.g. [(9, 10), (10, 9)].
+
+        Parameters
+        ----------
+        pairs : list of tuple
+            (row, column) pairs.
+        directed : bool, optional
+            If True, each pair only contributes the streamlines running from
+            its row to its column.  The default is False.
+
+        Returns
+        -------
+        indexes : numpy.ndarray
+            The indexes of the streamlines, without duplicates.
+
+        """
+        import numpy as np
+
+        if directed:
+            pairSlices=[self.directedIndexes(iRow,iColumn) for iRow, iColumn in pairs]
+        else:
+            pairSlices=[self.pairIndexes(iRow,iColumn) for iRow, iColumn in pairs]
+        return np.unique(np.concatenate(pairSlices+[np.zeros(0,dtype=np.int32)]))
+
+    def directedCounts(self):
+        """
+        Returns the (labelCount, labelCount) matrix of the number of
+        streamlines running from each label (row) to each label (column).
+        """
+        import numpy as np
+
+        codeCounts=np.diff(self.offsets).reshape(self.labelCount,self.labelCount,2)
+        #reversed streamlines are stored under the (lower, higher) pair
+        return codeCounts[:,:,0]+codeCounts[:,:,1].T
+
+    @property
+    def pairCodes(self):
+        """
+        The (N,) int32 matrix entry of each streamline, as the flat index
+        row*labelCount+column (with row<=column for a symmetric grouping),
+        or labelCount**2 for the streamlines in no entry.  Computed from
+        the sorted indexes on first use.
+        """
+        import numpy as np
+
+        if getattr(self,'_pairCodes',None) is None:
+            lowerPositions, higherPositions=np.divmod(np.arange(self.labelCount*self.labelCount,dtype=np.int64),self.labelCount)
+            forwardCodes=lowerPositions*self.labelCount+higherPositions
+            reversedCodes=forwardCodes if self.symmetric else higherPositions*self.labelCount+lowerPositions
+            #the code of each (pair, direction) section of streamlineIndexes
+            sectionCodes=np.stack((forwardCodes,reversedCodes),axis=1).reshape(-1)
+            self._pairCodes=np.full(self.streamlineCount,self.labelCount*self.labelCount,dtype=np.int32)
+            self._pairCodes[self.streamlineIndexes]=np.repeat(sectionCodes,np.diff(self.offsets))
+        return self._pairCodes
+
+    def maskedMatrix(self, streamlineMask):
+        """
+        Returns the connectivity matrix of a subset of the streamlines (e.g.
+        those meeting a segmentation criterion) with a single np.bincount,
+        i.e. the equivalent of WMA_pyFuncs.maskMatrixByBoolVec.
+
+        Parameters
+        ----------
+        streamlineMask : numpy.ndarray
+            Boolean vector over all of the streamlines, or the indexes of
+            the streamlines to count.
+
+        Returns
+        -------
+        matrix : numpy.ndarray
+            (labelCount, labelCount) int64 streamline counts.
+
+        """
+        import numpy as np
+
+        codeCounts=np.bincount(self.pairCodes[np.asarray(streamlineMask)],minlength=self.labelCount*self.labelCount+1)
+        return _countsToMatrix(codeCounts,self.labelCount,self.symmetric)
+
+    @property
+    def nbytes(self):
+        """
+        Returns the memory taken up by the grouping's arrays, in bytes.
+        """
+        return self.streamlineIndexes.nbytes+self.offsets.nbytes
+
+    def __getitem__(self, key):
+        row, column=key
+        if min(int(row),int(column))<0 or max(int(row),int(column))>=self.labelCount:
+            return self.streamlineIndexes[0:0]
+        if self.symmetric:
+            if int(row)>int(column):
+                return self.streamlineIndexes[0:0]
+            return self.pairIndexes(row,column)
+        return self.directedIndexes(row,column)
+
+    def keys(self):
+        import numpy as np
+
+        if self.symmetric:
+            #both directions of a pair are stored under its (lower, higher) code
+            rows, columns=np.nonzero(np.diff(self.offsets[0::2]).reshape(self.labelCount,self.labelCount))
+        else:
+            rows, columns=np.nonzero(self.directedCounts())
+        return [(iRow,iColumn) for iRow, iColumn in zip(rows.tolist(),columns.tolist())]
+
+    def values(self):
+        return [self[iKey] for iKey in self.keys()]
+
+    def items(self):
+        return [(iKey,self[iKey]) for iKey in self.keys()]
+
+    def __contains__(self, key):
+        return len(self[key])>0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+def _labelVolume(atlasIn):
+    """
+    Returns the integer label volume of an atlas image, path or array,
+    reusing the volume cached on the image by WiMSE_atlasFuncs.loadLabelVolume.
+    """
+    from . import WiMSE_atlasFuncs
+
+    if hasattr(atlasIn,'dataobj') or isinstance(atlasIn, str):
+        return WiMSE_atlasFuncs.loadLabelVolume(atlasIn)[0]
+    return WiMSE_atlasFuncs._atlasArray(atlasIn)
+
+
+def _voxelLookup(labelVolume, voxelIndexes, flatIndexes=None):
+    """
+    Returns labelVolume at (N, 3) voxelIndexes.  The indexes are converted
+    to flat indexes in the volume's memory order (kept in the flatIndexes
+    dict, for reuse with other volumes) and looked up with np.take, which is
+    considerably faster than indexing with three index arrays.
+    """
+    import numpy as np
+
+    if flatIndexes is None:
+        flatIndexes={}
+    memoryOrder='F' if labelVolume.flags.f_contiguous and not labelVolume.flags.c_contiguous else 'C'
+    if memoryOrder not in flatIndexes:
+        flatIndexes[memoryOrder]=np.ravel_multi_index((voxelIndexes[:,0],voxelIndexes[:,1],voxelIndexes[:,2]),labelVolume.shape[0:3],order=memoryOrder)
+    #reshaping in memory order doesn't copy contiguous volumes
+    return np.take(labelVolume.reshape(-1,order=memoryOrder),flatIndexes[memoryOrder])
+
+
+def _endpointVoxelIndexes(streamlinesIn, affine, volumeShape):
+    """
+    Returns the (2N, 3) voxel indexes of the first, then the last, nodes of
+    the streamlines (see endpointVoxels), along with a boolean vector of
+    the streamlines which have nodes.
+    """
+    import numpy as np
+    from . import WiMSE_tractFuncs
+
+    endpoint1, endpoint2=WiMSE_tractFuncs.streamlineEndpoints(streamlinesIn)
+    #both ends in one batch
+    voxelIndexes=endpointVoxels(np.concatenate((endpoint1,endpoint2)),affine,volumeShape)
+    return voxelIndexes, voxelIndexes[0:len(endpoint1),0]>=0
+
+
+def _endpointPositions(labelVolume, voxelIndexes, hasNodes, labels, flatIndexes=None):
+    """
+    Returns the (2, N) row / column index (see labelPositions) of both
+    endpoints of each streamline, -1 for the streamlines without nodes.
+    """
+    import numpy as np
+
+    if np.all(hasNodes):
+        return labelPositions(_voxelLookup(labelVolume,voxelIndexes,flatIndexes),labels).reshape(2,-1)
+    endsHaveNodes=np.concatenate((hasNodes,hasNodes))
+    endpointPositions=np.full(len(endsHaveNodes),-1,dtype=np.int64)
+    endpointPositions[endsHaveNodes]=labelPositions(_voxelLookup(labelVolume,voxelIndexes[endsHaveNodes],flatIndexes),labels)
+    return endpointPositions.reshape(2,-1)
+
+
+def endpointLabels(streamlinesIn, affine, atlasIn, emptyLabel=0):
+    """
+    Returns the atlas label at both endpoints of every streamline.  The
+    endpoints are read directly from the streamlines' flat points buffer
+    (see WiMSE_tractFuncs.streamlineEndpoints), mapped to voxels in one
+    batch and looked up with a single fancy indexing operation.
+
+    Parameters
+    ----------
+    streamlinesIn : str, Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines, or the path to a tractogram file.
+    affine : numpy.ndarray
+        (4, 4) voxel to world affine of the atlas.
+    atlasIn : nibabel.Nifti1Image, str or numpy.ndarray
+        The atlas, with any (e.g. FreeSurfer) label values.
+    emptyLabel : int, optional
+        Label given to both ends of the streamlines without nodes.  The
+        default is 0.
+
+    Returns
+    -------
+    labelsOut : numpy.ndarray
+        (2, N) label at the first (row 0) and last (row 1) node of each
+        streamline.
+
+    """
+    import numpy as np
+
+    labelVolume=_labelVolume(atlasIn)
+    voxelIndexes, hasNodes=_endpointVoxelIndexes(streamlinesIn,affine,labelVolume.shape)
+    if np.all(hasNodes):
+        return _voxelLookup(labelVolume,voxelIndexes).reshape(2,-1)
+    endsHaveNodes=np.concatenate((hasNodes,hasNodes))
+    labelsOut=np.full(len(endsHaveNodes),emptyLabel,dtype=np.result_type(labelVolume.dtype,np.min_scalar_type(emptyLabel)))
+    labelsOut[endsHaveNodes]=_voxelLookup(labelVolume,voxelIndexes[endsHaveNodes])
+    return labelsOut.reshape(2,-1)
+
+
+def labelPositions(labelValues, labels, maxLookupSize=2**24):
+    """
+    Returns the position of each of labelValues in labels, i.e. the
+    contiguous index used for the rows / columns of a connectivity matrix.
+    When the labels span a modest range (negative labels included) a lookup
+    table indexed by label value is used, otherwise the values are matched
+    with np.searchsorted.  Raises a ValueError for values which aren't in
+    labels.
+
+    Parameters
+    ----------
+    labelValues : array-like of int
+        Label values, e.g. as returned by endpointLabels.
+    labels : array-like of int
+        The labels of the matrix, in row order.  Must not repeat.
+    maxLookupSize : int, optional
+        Largest label range for which a lookup table is used.  The default
+        is 2**24.
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        Position of each value in labels, with the shape of labelValues.
+
+    """
+    import numpy as np
+
+    labels=np.asarray(labels,dtype=np.int64).reshape(-1)
+    labelValues=np.asarray(labelValues,dtype=np.int64)
+    if len(np.unique(labels))!=len(labels):
+        raise ValueError('labels must not contain duplicates')
+    if labelValues.size==0:
+        return np.zeros(labelValues.shape,dtype=np.int64)
+    if len(labels)==0:
+        positions=np.full(labelValues.shape,-1,dtype=np.int64)
+    elif int(labels.max())-int(labels.min())<maxLookupSize:
+        #table indexed by label value minus the smallest label
+        labelMin=int(labels.min())
+        labelToPosition=np.full(int(labels.max())-labelMin+1,-1,dtype=np.int64)
+        labelToPosition[labels-labelMin]=np.arange(len(labels),dtype=np.int64)
+        shiftedValues=labelValues-labelMin
+        isInRange=np.logical_and(shiftedValues>=0,shiftedValues<len(labelToPosition))
+        positions=np.where(isInRange,labelToPosition[np.where(isInRange,shiftedValues,0)],-1)
+    else:
+        labelOrder=np.argsort(labels)
+        sortedLabels=labels[labelOrder]
+        searchPositions=np.minimum(np.searchsorted(sortedLabels,labelValues),len(sortedLabels)-1)
+        positions=np.where(sortedLabels[searchPositions]==labelValues,labelOrder[searchPositions],-1)
+    if np.any(positions<0):
+        raise ValueError('endpoint label(s) %s are not in labels' % str(np.unique(labelValues[positions<0]).tolist()))
+    return positions
+
+
+def _matrixLabels(atlasIn, labels=None):
+    """
+    Returns the labels of the rows / columns of an atlas' connectivity
+    matrix: labels if provided, otherwise those present in the atlas.
+    """
+    import numpy as np
+    from . import WiMSE_atlasFuncs
+
+    if labels is None:
+        if hasattr(atlasIn,'dataobj') or isinstance(atlasIn, str):
+            labels=WiMSE_atlasFuncs.loadLabelVolume(atlasIn)[1]
+        else:
+            labels=WiMSE_atlasFuncs.uniqueAtlasLabels(atlasIn)
+    return np.asarray(labels,dtype=np.int64).reshape(-1)
+
+
+def _countsToMatrix(codeCounts, labelCount, symmetric=True):
+    """
+    Reshapes per pair code streamline counts into a connectivity matrix,
+    mirroring the (lower, higher) counts of a symmetric one.  Counts past
+    the last pair code (streamlines in no entry) are dropped.
+    """
+    import numpy as np
+
+    matrix=np.asarray(codeCounts[0:labelCount*labelCount]).astype(np.int64).reshape(labelCount,labelCount)
+    if symmetric:
+        matrix=np.maximum(matrix,matrix.T)
+    return matrix
+
+
+class CriteriaConnectivity(object):
+    """
+    Keeps the connectivity matrix of the streamlines meeting every one of a
+    changing selection of criteria (e.g. the SelectMultiple widgets of the
+    segmentation notebooks) up to date.  Rather than recounting every
+    streamline whenever a criterion is switched on or off, only the
+    streamlines whose pass / fail status changes are added to or subtracted
+    from the counts.
+    """
+
+    def __init__(self, grouping, criteria):
+        """
+        Parameters
+        ----------
+        grouping : StreamlineGrouping
+            The grouping of all of the streamlines, e.g. as returned by
+            connectivityMatrix.
+        criteria : dict
+            {name: boolean vector over the streamlines} of the available
+            criteria, True for the streamlines meeting the criterion.
+        """
+        import numpy as np
+
+        self.grouping=grouping
+        #only the streamlines failing a criterion are ever recounted
+        self.failingIndexes={iName:np.flatnonzero(np.logical_not(iCriterion)) for iName, iCriterion in criteria.items()}
+        self.activeCriteria=[]
+        #number of active criteria each streamline fails
+        self.failCounts=np.zeros(len(grouping.pairCodes),dtype=np.uint16)
+        self.codeCounts=np.bincount(grouping.pairCodes,minlength=grouping.labelCount*grouping.labelCount+1).astype(np.int64)
+
+    def _adjustCounts(self, streamlineIndexes, sign):
+        import numpy as np
+
+        self.codeCounts+=sign*np.bincount(self.grouping.pairCodes[streamlineIndexes],minlength=len(self.codeCounts))
+
+    def activateCriterion(self, name):
+        """
+        Adds a criterion to the selection, removing the streamlines which
+        fail it (and no other active criterion) from the counts.
+        """
+        if name in self.activeCriteria:
+            return
+        failingIndexes=self.failingIndexes[name]
+        self._adjustCounts(failingIndexes[self.failCounts[failingIndexes]==0],-1)
+        self.failCounts[failingIndexes]+=1
+        self.activeCriteria.append(name)
+
+    def deactivateCriterion(self, name):
+        """
+        Removes a criterion from the selection, restoring the streamlines
+        which only failed that criterion to the counts.
+        """
+        if name not in self.activeCriteria:
+            return
+        failingIndexes=self.failingIndexes[name]
+        self.failCounts[failingIndexes]-=1
+        self._adjustCounts(failingIndexes[self.failCounts[failingIndexes]==0],1)
+        self.activeCriteria.remove(name)
+
+    def setActiveCriteria(self, names):
+        """
+        Switches the selection to the given criteria, toggling only those
+        which differ from the current selection, and returns the matrix.
+        """
+        for iName in list(self.activeCriteria):
+            if iName not in names:
+                self.deactivateCriterion(iName)
+        for iName in names:
+            self.activateCriterion(iName)
+        return self.matrix()
+
+    def matrix(self):
+        """
+        Returns the connectivity matrix of the streamlines meeting all of
+        the active criteria.
+        """
+        return _countsToMatrix(self.codeCounts,self.grouping.labelCount,self.grouping.symmetric)
+
+    def passingStreamlines(self):
+        """
+        Returns a boolean vector of the streamlines meeting all of the
+        active criteria.
+        """
+        return self.failCounts==0
+
+
+class LengthConnectivity(object):
+    """
+    Answers "how many streamlines with a length between minLength and
+    maxLength connect each pair of labels" for the whole connectivity matrix
+    at once, e.g. for interactive length sliders.  Streamlines are sorted by
+    matrix entry and, within each entry, by length (as a rank among the
+    distinct lengths, so that the sort key is an exact integer).  The number
+    of streamlines of every entry below any length is then a single
+    np.searchsorted over the sorted keys, so a range query costs two
+    searches per matrix entry rather than a pass over the streamlines.
+    """
+
+    def __init__(self, grouping, lengths):
+        """
+        Parameters
+        ----------
+        grouping : StreamlineGrouping
+            The grouping of all of the streamlines, e.g. as returned by
+            connectivityMatrix.
+        lengths : array-like of float
+            (N,) length of each streamline, e.g. the 'arcLength' of
+            WiMSE_tractFuncs.computeStreamlineMetadata.
+        """
+        import numpy as np
+
+        lengths=np.asarray(lengths).reshape(-1)
+        if len(lengths)!=len(grouping.pairCodes):
+            raise ValueError('got %i lengths for %i streamlines' % (len(lengths),len(grouping.pairCodes)))
+        self.grouping=grouping
+        self.entryCount=grouping.labelCount*grouping.labelCount
+        self.uniqueLengths, lengthRanks=np.unique(lengths,return_inverse=True)
+        self.rankCount=len(self.uniqueLengths)
+        self.sortedKeys=np.sort(grouping.pairCodes.astype(np.int64)*self.rankCount+lengthRanks.reshape(-1))
+        self._entryKeys=np.arange(self.entryCount,dtype=np.int64)*self.rankCount
+        #position of the first streamline of each matrix entry in sortedKeys
+        self._entryOffsets=np.searchsorted(self.sortedKeys,self._entryKeys)
+
+    def _countsBelow(self, rankThresholds):
+        """
+        Returns the (entryCount, len(rankThresholds)) number of streamlines
+        of each matrix entry whose length rank is below each threshold.
+        """
+        import numpy as np
+
+        queryKeys=self._entryKeys[:,None]+np.asarray(rankThresholds,dtype=np.int64)[None,:]
+        return np.searchsorted(self.sortedKeys,queryKeys)-self._entryOffsets[:,None]
+
+    def rangeMatrix(self, minLength, maxLength):
+        """
+        Returns the connectivity matrix of the streamlines with a length in
+        [minLength, maxLength].
+        """
+        import numpy as np
+
+        rankThresholds=[np.searchsorted(self.uniqueLengths,minLength,side='left'),np.searchsorted(self.uniqueLengths,maxLength,side='right')]
+        countsBelow=self._countsBelow(rankThresholds)
+        codeCounts=np.maximum(countsBelow[:,1]-countsBelow[:,0],0)
+        return _countsToMatrix(codeCounts,self.grouping.labelCount,self.grouping.symmetric)
+
+    def lengthCube(self, binEdges):
+        """
+        Returns the length resolved connectivity matrix, i.e. the histogram
+        of the lengths of the streamlines of every matrix entry.
+
+        Parameters
+        ----------
+        binEdges : array-like of float
+            Increasing bin edges.  As with np.histogram, each bin but the
+            last excludes its upper edge.
+
+        Returns
+        -------
+        lengthCube : numpy.ndarray
+            (labelCount, labelCount, len(binEdges)-1) int64 streamline
+            counts.
+
+        """
+        import numpy as np
+
+        binEdges=np.asarray(binEdges)
+        rankThresholds=np.searchsorted(self.uniqueLengths,binEdges,side='left')
+        #the last bin includes its upper edge
+        rankThresholds[-1]=np.searchsorted(self.uniqueLengths,binEdges[-1],side='right')
+        binCounts=np.diff(self._countsBelow(rankThresholds),axis=1)
+        labelCount=self.grouping.labelCount
+        lengthCube=binCounts.astype(np.int64).reshape(labelCount,labelCount,-1)
+        if self.grouping.symmetric:
+            lengthCube=np.maximum(lengthCube,lengthCube.transpose(1,0,2))
+        return lengthCube
+
+
+def _connectivityFromPositions(endpointPositions, labelCount, symmetric=True, returnMapping=False):
+    """
+    Counts the connectivity matrix (and, if requested, builds the
+    StreamlineGrouping) of streamlines with the given (2, N) endpoint row /
+    column indexes, by encoding each pair as a single integer.  Streamlines
+    with -1 indexes (i.e. without nodes) are left out.
+    """
+    import numpy as np
+
+    if symmetric:
+        pairCodes=np.minimum(endpointPositions[0],endpointPositions[1])*labelCount+np.maximum(endpointPositions[0],endpointPositions[1])
+    else:
+        pairCodes=endpointPositions[0]*labelCount+endpointPositions[1]
+    isExcluded=endpointPositions[0]<0
+    if np.any(isExcluded):
+        pairCodes=np.where(isExcluded,labelCount*labelCount,pairCodes)
+    matrix=_countsToMatrix(np.bincount(pairCodes,minlength=labelCount*labelCount+1),labelCount,symmetric)
+    if not returnMapping:
+        return matrix
+    return matrix, StreamlineGrouping(endpointPositions,labelCount,symmetric=symmetric)
+
+
+def connectivityMatrix(streamlinesIn, affine, atlasIn, labels=None, symmetric=True, returnMapping=False):
+    """
+    Computes the connectivity matrix of a set of streamlines, i.e. the number
+    of streamlines connecting each pair of atlas labels, along with (if
+    requested) the indexes of the streamlines behind each entry.  A
+    vectorized replacement for dipy.tracking.utils.connectivity_matrix
+    (with mapping_as_streamlines=False): endpoints are labeled in one batch
+    (see endpointLabels), each streamline's pair of labels is encoded as a
+    single integer, and the matrix is counted with np.bincount.
+
+    Unlike dipy's, the rows and columns correspond to the entries of labels
+    rather than to label values, so atlases with arbitrary, non-contiguous,
+    label values (e.g. FreeSurfer's) can be used without renumbering them
+    first.  For an atlas renumbered as in the notebooks (all labels from 0
+    to N-1 present) the outputs are identical to dipy's.  Streamlines
+    without nodes are left out of the matrix and the grouping.
+
+    Parameters
+    ----------
+    streamlinesIn : str, Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines, or the path to a tractogram file.
+    affine : numpy.ndarray
+        (4, 4) voxel to world affine of the atlas.
+    atlasIn : nibabel.Nifti1Image, str or numpy.ndarray
+        The atlas.
+    labels : array-like of int, optional
+        The labels corresponding to the rows / columns of the matrix.  The
+        default is the labels present in the atlas, in ascending order
+        (e.g. uniqueAtlasEntries).
+    symmetric : bool, optional
+        If True (the default), the order of a streamline's endpoints is
+        disregarded: streamlines are counted under (lower, higher) label
+        index and the matrix is mirrored, as in dipy.
+    returnMapping : bool, optional
+        Whether to also return the streamline grouping.  The default is
+        False.
+
+    Returns
+    -------
+    matrix : numpy.ndarray
+        (len(labels), len(labels)) int64 streamline counts.
+    grouping : StreamlineGrouping
+        Only if returnMapping.  The indexes of the streamlines behind each
+        entry, keyed by (lower, higher) index when symmetric.
+
+    """
+    labels=_matrixLabels(atlasIn,labels)
+    labelVolume=_labelVolume(atlasIn)
+    voxelIndexes, hasNodes=_endpointVoxelIndexes(streamlinesIn,affine,labelVolume.shape)
+    endpointPositions=_endpointPositions(labelVolume,voxelIndexes,hasNodes,labels)
+    return _connectivityFromPositions(endpointPositions,len(labels),symmetric=symmetric,returnMapping=returnMapping)
+
+
+def multiAtlasConnectivity(streamlinesIn, affine, atlases, labels=None, symmetric=True, returnMapping=False):
+    """
+    Computes the connectivity matrices (see connectivityMatrix) of the same
+    streamlines for several atlases sharing a voxel grid, e.g. the gross
+    anatomy and hemisphere remappings of one parcellation.  The endpoints are
+    read and mapped to voxels only once, so each additional atlas costs a
+    single fancy indexing lookup rather than another pass over the
+    tractogram.
+
+    Parameters
+    ----------
+    streamlinesIn : str, Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines, or the path to a tractogram file.
+    affine : numpy.ndarray
+        (4, 4) voxel to world affine shared by the atlases.
+    atlases : dict
+        {name: nibabel.Nifti1Image, str or numpy.ndarray} of the atlases.
+    labels : dict, optional
+        {name: array-like of int} of the labels corresponding to the rows /
+        columns of each atlas' matrix.  Atlases without an entry use the
+        labels present in them, in ascending order.
+    symmetric : bool, optional
+        Whether the matrices are symmetric (the default) or directed.
+    returnMapping : bool, optional
+        Whether to also return the streamline groupings.  The default is
+        False.
+
+    Returns
+    -------
+    connectivityOut : dict
+        {name: matrix}, or {name: (matrix, grouping)} if returnMapping, for
+        each atlas.
+
+    """
+    import numpy as np
+
+    if labels is None:
+        labels={}
+    labelVolumes={iName:_labelVolume(iAtlas) for iName, iAtlas in atlases.items()}
+    volumeShapes=set([tuple(iVolume.shape[0:3]) for iVolume in labelVolumes.values()])
+    if len(volumeShapes)>1:
+        raise ValueError('atlases must share a voxel grid, got shapes %s' % str(sorted(volumeShapes)))
+    for iName, iAtlas in atlases.items():
+        if hasattr(iAtlas,'affine') and not np.allclose(iAtlas.affine,affine):
+            raise ValueError('the affine of atlas %s differs from the one provided' % str(iName))
+    if len(labelVolumes)==0:
+        return {}
+
+    voxelIndexes, hasNodes=_endpointVoxelIndexes(streamlinesIn,affine,volumeShapes.pop())
+
+    #flat indexes are shared by all of the atlases with the same memory order
+    flatIndexes={}
+    connectivityOut={}
+    for iName, iVolume in labelVolumes.items():
+        currentLabels=_matrixLabels(atlases[iName],labels.get(iName,None))
+        endpointPositions=_endpointPositions(iVolume,voxelIndexes,hasNodes,currentLabels,flatIndexes)
+        connectivityOut[iName]=_connectivityFromPositions(endpointPositions,len(currentLabels),symmetric=symmetric,returnMapping=returnMapping)
+    return connectivityOut
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for reading label lookup tables (e.g. FreesurferLookup.csv/.txt/.xlsx
+and GrossAnatomyLookup.csv) and translating between label numbers, label
+names, the contiguous indexes used for connectivity matrices, and gross
+anatomy categories without repeatedly filtering pandas tables.
+"""
+
+#the columns of a FreeSurferColorLUT
+lookupColumns=['#No.','LabelName:','R','G','B','A']
+
+
+def parseLookupTable(lookupPath):
+    """
+    Reads a label lookup table into a dictionary of numpy arrays, one per
+    column.  Comma separated (.csv), whitespace separated FreeSurferColorLUT
+    (.txt) and Excel (.xlsx, requires openpyxl) tables are supported.
+
+    Parameters
+    ----------
+    lookupPath : str
+        Path to the table.
+
+    Returns
+    -------
+    lookupArrays : dict
+        {column name: numpy.ndarray} for each column of the table.  Label
+        numbers ('#No.') and colors are integer arrays, other columns are
+        string arrays.  Unnamed index columns (as in GrossAnatomyLookup.csv)
+        are dropped.
+
+    """
+    import os
+    import numpy as np
+    import pandas as pd
+
+    fileExtension=os.path.splitext(lookupPath)[1].lower()
+    if fileExtension=='.txt':
+        rows=[]
+        with open(lookupPath,'r') as lookupFile:
+            for iLine in lookupFile:
+                lineEntries=iLine.split()
+                #skip blank lines and comments, including the '#No. LabelName: ...' header
+                if len(lineEntries)==0 or lineEntries[0].startswith('#'):
+                    continue
+                rows.append(lineEntries[0:len(lookupColumns)])
+        lookupTable=pd.DataFrame(rows,columns=lookupColumns)
+    elif fileExtension in ['.xlsx','.xls']:
+        lookupTable=pd.read_excel(lookupPath)
+    else:
+        lookupTable=pd.read_csv(lookupPath)
+
+    lookupArrays={}
+    for iColumn in lookupTable.columns:
+        if str(iColumn).startswith('Unnamed'):
+            continue
+        if iColumn in ['#No.','R','G','B','A']:
+            lookupArrays[iColumn]=lookupTable[iColumn].to_numpy().astype(np.int64)
+        else:
+            lookupArrays[iColumn]=lookupTable[iColumn].astype(str).to_numpy().astype(str)
+    return lookupArrays
+
+
+def loadLookupArrays(lookupPath, cacheDir=None):
+    """
+    Returns parseLookupTable(lookupPath), parsing the table only the first
+    time it is requested and reading the stored arrays from the cache (see
+    WiMSE_cacheFuncs.cachedCall) thereafter, until the table's content
+    changes.
+
+    Parameters
+    ----------
+    lookupPath : str
+        Path to the table.
+    cacheDir : str, optional
+        Path to the cache directory.  The default is
+        WiMSE_cacheFuncs.defaultCacheDir().
+
+    Returns
+    -------
+    lookupArrays : dict
+        {column name: numpy.ndarray} for each column of the table.
+
+    """
+    import os
+    from . import WiMSE_cacheFuncs
+
+    lookupPath=os.path.abspath(lookupPath)
+    return WiMSE_cacheFuncs.cachedCall(parseLookupTable,[lookupPath],lookupPath,cacheDir=cacheDir)
+
+
+def _denseLookup(keys, values, fillValue):
+    """
+    Returns an array such that denseArray[keys[i]]=values[i], and fillValue
+    for all other non-negative integers up to max(keys), so that label
+    numbers can be translated by indexing rather than by searching.
+    """
+    import numpy as np
+
+    keys=np.asarray(keys,dtype=np.int64)
+    values=np.asarray(values)
+    denseArray=np.full(max(int(keys.max()),0)+1 if len(keys)>0 else 1,fillValue,dtype=values.dtype)
+    isValid=keys>=0
+    denseArray[keys[isValid]]=values[isValid]
+    return denseArray
+
+
+class LabelLookup():
+    """
+    Translates between the label numbers of an atlas (e.g. FreeSurfer's 2 for
+    Left-Cerebral-White-Matter), their names, their contiguous indexes (the
+    renumbering used to compute dipy connectivity matrices, i.e. the position
+    of each label in uniqueAtlasEntries) and their gross anatomy categories.
+    All translations are array lookups, so they can be applied to single
+    labels (e.g. from a drop down) or to whole arrays of labels alike.
+
+    Parameters
+    ----------
+    lookupArrays : dict
+        {column name: numpy.ndarray} as returned by loadLookupArrays, with
+        at least the '#No.' and 'LabelName:' columns.
+    atlasLabels : array-like of int, optional
+        The labels present in the atlas, in the order of their contiguous
+        indexes (e.g. uniqueAtlasEntries).  The default is all of the labels
+        of the table, in ascending order.
+    categoryArrays : dict, optional
+        {column name: numpy.ndarray} of a table with categorical columns,
+        e.g. loadLookupArrays of GrossAnatomyLookup.csv.  Its columns other
+        than '#No.', 'LabelName:' and the colors become available through
+        labelCategory.
+    """
+
+    def __init__(self, lookupArrays, atlasLabels=None, categoryArrays=None):
+        import numpy as np
+
+        self.labelNumbers=np.asarray(lookupArrays['#No.'],dtype=np.int64)
+        self.labelNames=np.asarray(lookupArrays['LabelName:'])
+        if all([iColor in lookupArrays for iColor in ['R','G','B','A']]):
+            self.colors=np.stack([lookupArrays[iColor] for iColor in ['R','G','B','A']],axis=1).astype(np.uint8)
+        else:
+            self.colors=None
+        #table row of each label number, -1 where the number isn't in the table
+        self._numberToRow=_denseLookup(self.labelNumbers,np.arange(len(self.labelNumbers),dtype=np.int32),-1)
+        self._nameToNumber=dict(zip(self.labelNames.tolist(),self.labelNumbers.tolist()))
+
+        if atlasLabels is None:
+            atlasLabels=np.sort(self.labelNumbers)
+        self.atlasLabels=np.asarray(atlasLabels,dtype=np.int64)
+        self._numberToIndex=_denseLookup(self.atlasLabels,np.arange(len(self.atlasLabels),dtype=np.int32),-1)
+
+        self.categoryLists={}
+        self._numberToCategory={}
+        if categoryArrays is not None:
+            for iColumn in categoryArrays.keys():
+                if iColumn in lookupColumns:
+                    continue
+                #categories are numbered in order of first appearance, as with pandas' unique()
+                categoryList, firstPositions, rowCodes=np.unique(categoryArrays[iColumn],return_index=True,return_inverse=True)
+                appearanceOrder=np.argsort(firstPositions)
+                self.categoryLists[iColumn]=categoryList[appearanceOrder]
+                rowCodes=np.argsort(appearanceOrder)[rowCodes.reshape(-1)]
+                self._numberToCategory[iColumn]=_denseLookup(categoryArrays['#No.'],rowCodes.astype(np.int32),-1)
+
+    @staticmethod
+    def _lookup(denseArray, keys, fillValue):
+        """
+        Indexes denseArray with keys, returning fillValue for keys outside of
+        its range.
+        """
+        import numpy as np
+
+        #single labels, e.g. from a drop down, are the common case
+        if np.ndim(keys)==0:
+            if 0<=int(keys)<len(denseArray):
+                return denseArray[int(keys)].item()
+            return fillValue
+        keys=np.asarray(keys,dtype=np.int64)
+        isInRange=np.logical_and(keys>=0,keys<len(denseArray))
+        values=np.where(isInRange,denseArray[np.where(isInRange,keys,0)],fillValue)
+        if values.ndim==0:
+            return values.item()
+        return values
+
+    def labelIndex(self, labelNumbers):
+        """
+        Returns the contiguous index (position in atlasLabels) of label
+        number(s), or -1 for labels not in the atlas.
+        """
+        return self._lookup(self._numberToIndex,labelNumbers,-1)
+
+    def labelNumber(self, labelIndexes):
+        """
+        Returns the label number(s) of contiguous index(es).
+        """
+        import numpy as np
+
+        labelNumbers=self.atlasLabels[np.asarray(labelIndexes,dtype=np.int64)]
+        if labelNumbers.ndim==0:
+            return labelNumbers.item()
+        return labelNumbers
+
+    def labelName(self, labelNumbers):
+        """
+        Returns the name(s) of label number(s), or '' for labels not in the
+        table.
+        """
+        import numpy as np
+
+        labelRows=np.asarray(self._lookup(self._numberToRow,labelNumbers,-1))
+        labelNames=np.where(labelRows>=0,self.labelNames[np.maximum(labelRows,0)],'')
+        if labelNames.ndim==0:
+            return str(labelNames)
+        return labelNames
+
+    def labelNumberFromName(self, labelNames):
+        """
+        Returns the label number(s) of label name(s).  Raises a KeyError for
+        names not in the table.
+        """
+        import numpy as np
+
+        if isinstance(labelNames, str):
+            return self._nameToNumber[labelNames]
+        return np.array([self._nameToNumber[iName] for iName in labelNames],dtype=np.int64)
+
+    def labelColor(self, labelNumbers):
+        """
+        Returns the R, G, B, A color(s) of label number(s).
+        """
+        import numpy as np
+
+        labelRows=np.asarray(self._lookup(self._numberToRow,labelNumbers,-1))
+        if np.any(labelRows<0):
+            raise KeyError('label(s) %s are not in the table' % str(np.atleast_1d(labelNumbers)[np.atleast_1d(labelRows)<0].tolist()))
+        return self.colors[labelRows]
+
+    def labelCategory(self, labelNumbers, column, asName=False):
+        """
+        Returns the category (e.g. of the 'GrossAnat' or 'Hemi' column) of
+        label number(s), either as its position in categoryLists[column]
+        (-1 for uncategorized labels) or as its name.
+        """
+        import numpy as np
+
+        categoryCodes=self._lookup(self._numberToCategory[column],labelNumbers,-1)
+        if not asName:
+            return categoryCodes
+        categoryCodes=np.asarray(categoryCodes)
+        categoryNames=np.where(categoryCodes>=0,self.categoryLists[column][np.maximum(categoryCodes,0)],'')
+        if categoryNames.ndim==0:
+            return str(categoryNames)
+        return categoryNames
+
+    def atlasEntries(self):
+        """
+        Returns the table rows of the atlas' labels as a pandas DataFrame
+        (equivalent to FSTable.loc[FSTable['#No.'].isin(uniqueAtlasEntries)]
+        with reset indexes, in atlasLabels order), e.g. for display or for
+        building drop down lists.
+        """
+        import numpy as np
+        import pandas as pd
+
+        labelRows=np.asarray(self._lookup(self._numberToRow,self.atlasLabels,-1)).reshape(-1)
+        atlasEntries=pd.DataFrame({'#No.':self.atlasLabels,'LabelName:':self.labelName(self.atlasLabels)})
+        if self.colors is not None:
+            for iChannel, iColor in enumerate(['R','G','B','A']):
+                atlasEntries[iColor]=np.where(labelRows>=0,self.colors[np.maximum(labelRows,0),iChannel],0)
+        for iColumn in self.categoryLists.keys():
+            atlasEntries[iColumn]=self.labelCategory(self.atlasLabels,iColumn,asName=True)
+        return atlasEntries
+
+
+def loadLabelLookup(lookupPath, atlasLabels=None, categoryPath=None, cacheDir=None):
+    """
+    Returns a LabelLookup for a lookup table, using cached parses of the
+    table(s) where available.
+
+    Parameters
+    ----------
+    lookupPath : str
+        Path to the label table, e.g. exampleData/FreesurferLookup.csv
+    atlasLabels : array-like of int, optional
+        The labels present in the atlas, in contiguous index order (e.g.
+        uniqueAtlasEntries).  The default is all of the table's labels.
+    categoryPath : str, optional
+        Path to a table with categorical columns, e.g.
+        exampleData/GrossAnatomyLookup.csv
+    cacheDir : str, optional
+        Path to the cache directory.  The default is
+        WiMSE_cacheFuncs.defaultCacheDir().
+
+    Returns
+    -------
+    labelLookup : LabelLookup
+        The label translator.
+
+    """
+    lookupArrays=loadLookupArrays(lookupPath,cacheDir=cacheDir)
+    categoryArrays=None
+    if categoryPath is not None:
+        categoryArrays=loadLookupArrays(categoryPath,cacheDir=cacheDir)
+    return LabelLookup(lookupArrays,atlasLabels=atlasLabels,categoryArrays=categoryArrays)
@@ -0,0 +1,1744 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for storing, loading and subsetting tractograms.
+
+These are intended to sit alongside the WMA_pyFuncs set (see the wma_pyTools
+submodule) and return objects that can be handed directly to the functions
+used throughout the WiMSE notebooks (e.g. extractSubTractogram,
+dipy.tracking.utils.connectivity_matrix, WMA_pyFuncs.applyNiftiCriteriaToTract)
+"""
+
+
+def flatTractogramPaths(flatStem):
+    """
+    Returns the paths of the files which make up a flat tractogram store.
+
+    Parameters
+    ----------
+    flatStem : str
+        Path stem (i.e. path without extension) of the flat tractogram store.
+
+    Returns
+    -------
+    pointsPath : str
+        Path to the raw float32 file holding the points of every streamline,
+        stored as a contiguous (nb_points, 3) array.
+    offsetsPath : str
+        Path to the raw int64 file holding the (offset, length) pair of every
+        streamline, stored as a contiguous (nb_streamlines, 2) array.
+    headerPath : str
+        Path to the json file holding the array sizes and the affine.
+
+    """
+    pointsPath=flatStem+'_points.f32'
+    offsetsPath=flatStem+'_offsets.i64'
+    headerPath=flatStem+'_header.json'
+    return pointsPath, offsetsPath, headerPath
+
+
+def convertTractogramToFlat(tractogramPaths, flatStem, blockSize=100000):
+    """
+    Converts one or more tractogram files (e.g. .tck) into a flat tractogram
+    store which can later be opened, nearly instantly, with loadFlatTractogram.
+    If multiple paths are passed, the streamlines are stored in the order of
+    the input paths, as if they had been concatenated.
+
+    Parameters
+    ----------
+    tractogramPaths : str or list of str
+        Path(s) to tractogram files readable by nibabel.streamlines.load.
+    flatStem : str
+        Path stem for the output files.  See flatTractogramPaths for the
+        files that get written.
+    blockSize : int, optional
+        Number of streamlines to hold in memory before writing them to disk.
+        The default is 100000.
+
+    Returns
+    -------
+    flatStem : str
+        The input path stem, for convenience.
+
+    """
+    import nibabel as nib
+    import numpy as np
+    import json
+    import os
+
+    #allow for a single path to be passed
+    if isinstance(tractogramPaths, str):
+        tractogramPaths=[tractogramPaths]
+
+    pointsPath, offsetsPath, headerPath=flatTractogramPaths(flatStem)
+
+    #running counts of what has been written
+    pointCount=0
+    lengthsList=[]
+    affine_to_rasmm=None
+    #open the points file and write to it in buffered batches
+    with open(pointsPath,'wb') as pointsFile:
+        for iPath in tractogramPaths:
+            if affine_to_rasmm is None:
+                #only the header is read here
+                affine_to_rasmm=np.asarray(nib.streamlines.load(iPath, lazy_load=True).tractogram.affine_to_rasmm)
+            #streaming the blocks avoids holding the entire source file in memory
+            for blockStart, blockStreamlines in iterateTractogramBlocks(iPath, blockSize=blockSize):
+                blockStreamlines._data.astype('<f4',copy=False).tofile(pointsFile)
+                lengthsList.append(np.asarray(blockStreamlines._lengths,dtype=np.int64))
+                pointCount=pointCount+len(blockStreamlines._data)
+
+    #compute the offsets from the lengths
+    if len(lengthsList)>0:
+        lengths=np.concatenate(lengthsList)
+    else:
+        lengths=np.zeros(0,dtype=np.int64)
+    offsets=np.zeros(len(lengths),dtype=np.int64)
+    offsets[1:]=np.cumsum(lengths)[:-1]
+    np.column_stack((offsets,lengths)).astype('<i8').tofile(offsetsPath)
+
+    if affine_to_rasmm is None:
+        affine_to_rasmm=np.eye(4)
+    #store the information needed to interpret the raw files
+    header={'nb_streamlines':int(len(lengths)),
+            'nb_points':int(pointCount),
+            'affine_to_rasmm':affine_to_rasmm.tolist(),
+            'source_files':[os.path.abspath(iPath) for iPath in tractogramPaths]}
+    with open(headerPath,'w') as headerFile:
+        json.dump(header,headerFile,indent=1)
+
+    return flatStem
+
+
+def loadFlatTractogram(flatStem):
+    """
+    Opens a flat tractogram store created by convertTractogramToFlat.  The
+    point and offset arrays are memory mapped rather than read, so opening is
+    essentially instantaneous regardless of tractogram size, and only the
+    portions of the file which are actually accessed are read from disk.
+
+    Parameters
+    ----------
+    flatStem : str
+        Path stem of the flat tractogram store.
+
+    Returns
+    -------
+    tractogram : nibabel.streamlines.tractogram.Tractogram
+        A tractogram whose .streamlines ArraySequence is backed by the memory
+        mapped arrays.  As such it can be passed to extractSubTractogram,
+        dipy.tracking.utils.connectivity_matrix, and the WMA_pyFuncs criteria
+        functions like any other tractogram.
+
+    """
+    import nibabel as nib
+    import numpy as np
+    import json
+
+    pointsPath, offsetsPath, headerPath=flatTractogramPaths(flatStem)
+    with open(headerPath,'r') as headerFile:
+        header=json.load(headerFile)
+
+    #empty files can't be memory mapped, but streamlines without points still count
+    if header['nb_points']==0:
+        points=np.zeros((0,3),dtype='<f4')
+    else:
+        points=np.memmap(pointsPath,dtype='<f4',mode='r',shape=(header['nb_points'],3))
+    if header['nb_streamlines']==0:
+        offsetsLengths=np.zeros((0,2),dtype='<i8')
+    else:
+        offsetsLengths=np.memmap(offsetsPath,dtype='<i8',mode='r',shape=(header['nb_streamlines'],2))
+
+    #set the ArraySequence internals directly, this avoids any copying
+    streamlines=nib.streamlines.ArraySequence()
+    streamlines._data=points
+    streamlines._offsets=offsetsLengths[:,0]
+    streamlines._lengths=offsetsLengths[:,1]
+
+    tractogram=nib.streamlines.tractogram.Tractogram(streamlines=streamlines,
+                                                     affine_to_rasmm=np.asarray(header['affine_to_rasmm']))
+    return tractogram
+
+
+def _arraySequenceFromFlat(points, lengths):
+    """
+    Wraps a flat (nb_points, 3) points array and its per-streamline lengths
+    in an ArraySequence, without copying.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        (nb_points, 3) array of streamline points, stored contiguously.
+    lengths : numpy.ndarray
+        Number of points in each streamline.
+
+    Returns
+    -------
+    streamlines : nibabel.streamlines.ArraySequence
+        ArraySequence view of the points.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    lengths=np.asarray(lengths,dtype=np.int64)
+    offsets=np.zeros(len(lengths),dtype=np.int64)
+    offsets[1:]=np.cumsum(lengths)[:-1]
+
+    streamlines=nib.streamlines.ArraySequence()
+    streamlines._data=points
+    streamlines._offsets=offsets
+    streamlines._lengths=lengths
+    return streamlines
+
+
+def iterateTckBlocks(tckPath, blockSize=100000, readSize=16):
+    """
+    Reads a .tck file in blocks of a fixed number of streamlines.  Only the
+    current block (plus one read buffer) is ever held in memory, so the peak
+    memory use is bounded regardless of the size of the file.
+
+    Parameters
+    ----------
+    tckPath : str
+        Path to the .tck file.
+    blockSize : int, optional
+        Number of streamlines in each block.  The final block may be smaller.
+        The default is 100000.
+    readSize : float, optional
+        Size (in MB) of each read from disk.  The default is 16.
+
+    Yields
+    ------
+    blockStart : int
+        Index, within the whole tractogram, of the first streamline in the
+        block.
+    blockStreamlines : nibabel.streamlines.ArraySequence
+        The streamlines of the block, in RAS+ mm, with contiguous data.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    #use nibabel's header parser to get the data type and data location
+    header=nib.streamlines.tck.TckFile._read_header(tckPath)
+    fileDtype=np.dtype(header['_dtype'])
+    rowBytes=3*fileDtype.itemsize
+    #make the read size a whole number of rows
+    readBytes=max(int(readSize*1024*1024)//rowBytes,1)*rowBytes
+
+    #rows of a streamline which has not been terminated yet
+    carryRows=np.zeros((0,3),dtype=np.float32)
+    #complete streamlines which have not been yielded yet
+    pendingPoints=[]
+    pendingLengths=[]
+    pendingCount=0
+    blockStart=0
+    leftoverBytes=b''
+    finished=False
+
+    with open(tckPath,'rb') as tckFile:
+        tckFile.seek(header['_offset_data'])
+        while not finished:
+            readBuffer=tckFile.read(readBytes)
+            if len(readBuffer)==0:
+                finished=True
+                newRows=np.zeros((0,3),dtype=np.float32)
+            else:
+                readBuffer=leftoverBytes+readBuffer
+                #hold on to any partial row for the next read
+                usableBytes=(len(readBuffer)//rowBytes)*rowBytes
+                leftoverBytes=readBuffer[usableBytes:]
+                newRows=np.frombuffer(readBuffer[:usableBytes],dtype=fileDtype).reshape(-1,3).astype(np.float32)
+            rows=np.concatenate((carryRows,newRows))
+
+            #an infinite row marks the end of the data
+            endRows=np.flatnonzero(np.isinf(rows[:,0]))
+            if len(endRows)>0:
+                rows=rows[:endRows[0]]
+                finished=True
+            #a nan row marks the end of each streamline
+            isDelimiter=np.isnan(rows[:,0])
+            delimiterRows=np.flatnonzero(isDelimiter)
+            if finished and (len(delimiterRows)==0 or delimiterRows[-1]!=len(rows)-1) and len(rows)>0:
+                #some writers don't delimit the final streamline
+                rows=np.concatenate((rows,np.full((1,3),np.nan,dtype=np.float32)))
+                isDelimiter=np.append(isDelimiter,True)
+                delimiterRows=np.append(delimiterRows,len(rows)-1)
+
+            if len(delimiterRows)>0:
+                lastComplete=delimiterRows[-1]+1
+                #the number of points between consecutive delimiters
+                streamStarts=np.concatenate(([0],delimiterRows[:-1]+1))
+                pendingLengths.append(delimiterRows-streamStarts)
+                pendingPoints.append(rows[:lastComplete][~isDelimiter[:lastComplete]])
+                pendingCount=pendingCount+len(delimiterRows)
+                carryRows=rows[lastComplete:]
+            else:
+                carryRows=rows
+
+            #yield as many full blocks as are available (all of them at the end)
+            if pendingCount>=blockSize or (finished and pendingCount>0):
+                allPoints=np.concatenate(pendingPoints)
+                allLengths=np.concatenate(pendingLengths)
+                pointStarts=np.concatenate(([0],np.cumsum(allLengths)))
+                currentStream=0
+                while pendingCount-currentStream>=blockSize or (finished and currentStream<pendingCount):
+                    blockEnd=min(currentStream+blockSize,pendingCount)
+                    blockPoints=allPoints[pointStarts[currentStream]:pointStarts[blockEnd]]
+                    yield blockStart, _arraySequenceFromFlat(blockPoints,allLengths[currentStream:blockEnd])
+                    blockStart=blockStart+blockEnd-currentStream
+                    currentStream=blockEnd
+                #keep the remainder for the next block
+                pendingPoints=[allPoints[pointStarts[currentStream]:]]
+                pendingLengths=[allLengths[currentStream:]]
+                pendingCount=pendingCount-currentStream
+
+
+def iterateTractogramBlocks(tractogramPath, blockSize=100000):
+    """
+    Reads a tractogram file in blocks of a fixed number of streamlines.  .tck
+    files are read with iterateTckBlocks, .qtk files (see
+    saveQuantizedTractogram) with iterateQuantizedBlocks, using the block size
+    they were saved with, and other formats through nibabel's lazy loading.
+
+    Parameters
+    ----------
+    tractogramPath : str
+        Path to a tractogram file readable by nibabel.streamlines.load.
+    blockSize : int, optional
+        Number of streamlines in each block.  The default is 100000.
+
+    Yields
+    ------
+    blockStart : int
+        Index, within the whole tractogram, of the first streamline in the
+        block.
+    blockStreamlines : nibabel.streamlines.ArraySequence
+        The streamlines of the block, in RAS+ mm, with contiguous data.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if tractogramPath.lower().endswith('.tck'):
+        yield from iterateTckBlocks(tractogramPath, blockSize=blockSize)
+        return
+    if tractogramPath.lower().endswith('.qtk'):
+        #quantized files have their own block size
+        yield from iterateQuantizedBlocks(tractogramPath)
+        return
+
+    lazyTractogram=nib.streamlines.load(tractogramPath, lazy_load=True).tractogram
+    blockStart=0
+    currentBlock=[]
+    for iStreamline in lazyTractogram.streamlines:
+        currentBlock.append(np.asarray(iStreamline,dtype=np.float32))
+        if len(currentBlock)==blockSize:
+            yield blockStart, _arraySequenceFromFlat(np.concatenate(currentBlock),[len(iStream) for iStream in currentBlock])
+            blockStart=blockStart+len(currentBlock)
+            currentBlock=[]
+    if len(currentBlock)>0:
+        yield blockStart, _arraySequenceFromFlat(np.concatenate(currentBlock),[len(iStream) for iStream in currentBlock])
+
+
+def iterateCriteriaBlocks(tractogramPath, criteriaList, blockSize=100000):
+    """
+    Applies one or more streamline criteria functions (e.g.
+    WMA_pyFuncs.applyNiftiCriteriaToTract, applyEndpointCriteria or
+    applyMidpointCriteria) to a tractogram file block by block, such that the
+    whole tractogram never needs to be held in memory.  All of the criteria
+    are evaluated on each block while it is loaded, so the file is only read
+    once.
+
+    Parameters
+    ----------
+    tractogramPath : str
+        Path to a tractogram file, ideally a .tck file.
+    criteriaList : list of tuples
+        Each entry is a (criteriaFunction, criteriaArgs) tuple.  Each
+        criteriaFunction is called as criteriaFunction(blockStreamlines,
+        *criteriaArgs) and must return one boolean value per streamline, e.g.
+        (WMA_pyFuncs.applyNiftiCriteriaToTract, (planeNifti, True, 'any')).
+    blockSize : int, optional
+        Number of streamlines evaluated at a time.  The default is 100000.
+
+    Yields
+    ------
+    blockStart : int
+        Index, within the whole tractogram, of the first streamline in the
+        block.
+    blockBools : numpy.ndarray
+        (len(criteriaList), nb_streamlines_in_block) boolean array holding the
+        result of each criteria for the streamlines of the block.
+
+    """
+    import numpy as np
+
+    for blockStart, blockStreamlines in iterateTractogramBlocks(tractogramPath, blockSize=blockSize):
+        blockBools=np.zeros((len(criteriaList),len(blockStreamlines)),dtype=bool)
+        for iCriteria, (criteriaFunction, criteriaArgs) in enumerate(criteriaList):
+            blockBools[iCriteria,:]=np.asarray(criteriaFunction(blockStreamlines,*criteriaArgs)).astype(bool)
+        yield blockStart, blockBools
+
+
+def applyCriteriaStreaming(tractogramPath, criteriaList, blockSize=100000):
+    """
+    Convenience wrapper around iterateCriteriaBlocks which assembles the
+    per-block outputs into full length boolean vectors.  These are only one
+    byte per streamline per criteria, so they stay small even when the
+    tractogram itself would not fit in memory.
+
+    Parameters
+    ----------
+    tractogramPath : str
+        Path to a tractogram file, ideally a .tck file.
+    criteriaList : list of tuples
+        See iterateCriteriaBlocks.
+    blockSize : int, optional
+        Number of streamlines evaluated at a time.  The default is 100000.
+
+    Returns
+    -------
+    criteriaBools : numpy.ndarray
+        (len(criteriaList), nb_streamlines) boolean array.
+
+    """
+    import numpy as np
+
+    blockBoolsList=[np.zeros((len(criteriaList),0),dtype=bool)]
+    for blockStart, blockBools in iterateCriteriaBlocks(tractogramPath, criteriaList, blockSize=blockSize):
+        blockBoolsList.append(blockBools)
+    return np.concatenate(blockBoolsList,axis=1)
+
+
+def _asArraySequence(tractogramIn):
+    """
+    Returns the streamlines ArraySequence of a path, tractogram file object,
+    tractogram object or ArraySequence.
+
+    Parameters
+    ----------
+    tractogramIn : str, TractogramFile, Tractogram or ArraySequence
+        If str, the path to a tractogram file, which is loaded with
+        nibabel.streamlines.load.
+
+    Returns
+    -------
+    streamlines : nibabel.streamlines.ArraySequence
+        The streamlines of the input, not copied.
+
+    """
+    import nibabel as nib
+
+    if isinstance(tractogramIn, str):
+        tractogramIn=nib.streamlines.load(tractogramIn)
+    if hasattr(tractogramIn,'streamlines'):
+        tractogramIn=tractogramIn.streamlines
+    return tractogramIn
+
+
+class MultiFileTractogram(object):
+    """
+    Presents several tractograms (e.g. length-binned .tck files) as a single
+    indexable tractogram, without concatenating (i.e. copying) their data.
+
+    Global streamline indexes follow the order of the inputs, exactly as if
+    the inputs had been concatenated with np.concatenate.  Indexing with an
+    int returns the streamline's points, indexing with a slice, list, integer
+    array or boolean array returns a new MultiFileTractogram holding
+    ArraySequence views of the selected streamlines.
+
+    Because .streamlines returns the object itself, it can stand in for the
+    sourceTractogram of the segmentation notebooks, i.e. it can be passed to
+    extractSubTractogram, dipy.tracking.utils.connectivity_matrix and the
+    WMA_pyFuncs criteria functions.
+    """
+
+    def __init__(self, tractograms, affine_to_rasmm=None):
+        """
+        Parameters
+        ----------
+        tractograms : list
+            List of paths, tractogram file objects (as returned by
+            nibabel.streamlines.load), tractograms or ArraySequences.
+        affine_to_rasmm : numpy.ndarray, optional
+            Affine carried along for consistency with nibabel Tractograms.
+            The default is the identity, as the streamlines of nibabel loaded
+            tractograms are already in RAS+ mm.
+        """
+        import numpy as np
+
+        self.sequences=[_asArraySequence(iTractogram) for iTractogram in tractograms]
+        self.fileLengths=np.asarray([len(iSequence) for iSequence in self.sequences],dtype=np.int64)
+        #global index of the first streamline of each input
+        self.fileStarts=np.concatenate(([0],np.cumsum(self.fileLengths)[:-1])).astype(np.int64)
+        if affine_to_rasmm is None:
+            affine_to_rasmm=np.eye(4)
+        self.affine_to_rasmm=np.asarray(affine_to_rasmm)
+
+    @property
+    def streamlines(self):
+        return self
+
+    def __len__(self):
+        return int(self.fileLengths.sum())
+
+    def __iter__(self):
+        for iSequence in self.sequences:
+            for iStreamline in iSequence:
+                yield iStreamline
+
+    def globalToLocal(self, indexes):
+        """
+        Translates global streamline indexes into (input, local index) pairs.
+
+        Parameters
+        ----------
+        indexes : int or array-like of int
+            Global streamline indexes.  Negative values count from the end.
+
+        Returns
+        -------
+        fileIndexes : numpy.ndarray
+            Index of the input holding each streamline.
+        localIndexes : numpy.ndarray
+            Index of each streamline within its input.
+
+        """
+        import numpy as np
+
+        indexes=np.asarray(indexes,dtype=np.int64)
+        totalLength=len(self)
+        indexes=np.where(indexes<0,indexes+totalLength,indexes)
+        if np.any(np.logical_or(indexes<0,indexes>=totalLength)):
+            raise IndexError('streamline index out of range for tractogram of length %i' % totalLength)
+        #side='right' skips past empty inputs which share a start index
+        fileIndexes=np.searchsorted(self.fileStarts,indexes,side='right')-1
+        localIndexes=indexes-self.fileStarts[fileIndexes]
+        return fileIndexes, localIndexes
+
+    def localToGlobal(self, fileIndex, localIndexes):
+        """
+        Translates streamline indexes within one input into global indexes.
+
+        Parameters
+        ----------
+        fileIndex : int
+            Index of the input.
+        localIndexes : int or array-like of int
+            Streamline indexes within that input.
+
+        Returns
+        -------
+        globalIndexes : numpy.ndarray
+            The corresponding global streamline indexes.
+
+        """
+        import numpy as np
+
+        return np.asarray(localIndexes,dtype=np.int64)+self.fileStarts[fileIndex]
+
+    def __getitem__(self, idx):
+        import numpy as np
+        import numbers
+
+        if isinstance(idx, (numbers.Integral, np.integer)):
+            fileIndexes, localIndexes=self.globalToLocal(idx)
+            return self.sequences[int(fileIndexes)][int(localIndexes)]
+
+        #convert every other kind of index to an integer array
+        if isinstance(idx, slice):
+            idx=np.arange(len(self))[idx]
+        idx=np.asarray(idx)
+        if idx.dtype==bool:
+            idx=np.flatnonzero(idx)
+        fileIndexes, localIndexes=self.globalToLocal(idx)
+
+        #split into runs of consecutive streamlines from the same input, so
+        #that the requested order is preserved
+        runBreaks=np.flatnonzero(np.diff(fileIndexes))+1
+        runStarts=np.concatenate(([0],runBreaks)).astype(np.int64)
+        runEnds=np.concatenate((runBreaks,[len(idx)])).astype(np.int64)
+        subSequences=[]
+        for iStart, iEnd in zip(runStarts,runEnds):
+            if iEnd>iStart:
+                #nibabel fancy indexing returns a view of the data
+                subSequences.append(self.sequences[fileIndexes[iStart]][localIndexes[iStart:iEnd]])
+        return MultiFileTractogram(subSequences,affine_to_rasmm=self.affine_to_rasmm)
+
+    def toArraySequence(self):
+        """
+        Copies the streamlines into a single contiguous ArraySequence, e.g.
+        for saving.
+
+        Returns
+        -------
+        streamlines : nibabel.streamlines.ArraySequence
+            A copy of the streamlines.
+
+        """
+        import nibabel as nib
+
+        streamlines=nib.streamlines.ArraySequence()
+        for iSequence in self.sequences:
+            streamlines.extend(iSequence)
+        return streamlines
+
+
+def _gatherStreamlinePoints(streamlines, indexes):
+    """
+    Copies the points of the selected streamlines of an ArraySequence into a
+    new, contiguous, points array with a single fancy indexing operation.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence
+        The source streamlines.
+    indexes : numpy.ndarray
+        Integer indexes of the streamlines to gather, in output order.
+
+    Returns
+    -------
+    points : numpy.ndarray
+        (nb_points, 3) array with the points of the selected streamlines.
+    lengths : numpy.ndarray
+        Number of points in each selected streamline.
+
+    """
+    import numpy as np
+
+    lengths=np.asarray(streamlines._lengths[indexes],dtype=np.int64)
+    offsets=np.asarray(streamlines._offsets[indexes],dtype=np.int64)
+    outputStarts=np.concatenate(([0],np.cumsum(lengths)[:-1])).astype(np.int64)
+    #the source row of every output row is its output row plus the shift of its streamline
+    sourceRows=np.arange(lengths.sum(),dtype=np.int64)+np.repeat(offsets-outputStarts,lengths)
+    return streamlines._data[sourceRows], lengths
+
+
+class SubTractogramView(object):
+    """
+    A lightweight subset of a tractogram, holding only a reference to the
+    parent tractogram and an array of streamline indexes.  No points are
+    copied until materialize (or toTractogram) is called, e.g. by a writer.
+
+    Views of views are composed, i.e. indexing a SubTractogramView returns a
+    new SubTractogramView of the original parent, so chains of subsets never
+    accumulate intermediate objects.
+
+    Because .streamlines returns the view itself, it can stand in for the
+    output of the notebooks' extractSubTractogram.
+    """
+
+    def __init__(self, parent, indexes):
+        """
+        Parameters
+        ----------
+        parent : Tractogram, TractogramFile, ArraySequence, MultiFileTractogram or SubTractogramView
+            The tractogram being subset.
+        indexes : array-like of int or bool
+            Indexes of the streamlines of the parent which make up the view.
+        """
+        import numpy as np
+
+        indexes=np.asarray(indexes)
+        if indexes.dtype==bool:
+            indexes=np.flatnonzero(indexes)
+        indexes=indexes.astype(np.int64).reshape(-1)
+        #compose views of views so that the parent is never a view
+        if isinstance(parent, SubTractogramView):
+            indexes=parent.indexes[indexes]
+            parent=parent.parent
+        self.parent=parent
+        self.indexes=indexes
+
+    @property
+    def streamlines(self):
+        return self
+
+    @property
+    def affine_to_rasmm(self):
+        import numpy as np
+        return getattr(self.parent,'affine_to_rasmm',np.eye(4))
+
+    def _parentStreamlines(self):
+        if hasattr(self.parent,'streamlines'):
+            return self.parent.streamlines
+        return self.parent
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __iter__(self):
+        parentStreamlines=self._parentStreamlines()
+        for iIndex in self.indexes:
+            yield parentStreamlines[int(iIndex)]
+
+    def __getitem__(self, idx):
+        import numbers
+        import numpy as np
+
+        if isinstance(idx, (numbers.Integral, np.integer)):
+            return self._parentStreamlines()[int(self.indexes[idx])]
+        if isinstance(idx, slice):
+            return SubTractogramView(self.parent,self.indexes[idx])
+        idx=np.asarray(idx)
+        if idx.dtype==bool:
+            idx=np.flatnonzero(idx)
+        return SubTractogramView(self.parent,self.indexes[idx])
+
+    def materialize(self):
+        """
+        Copies the points of the view into a new, contiguous, ArraySequence.
+
+        Returns
+        -------
+        streamlines : nibabel.streamlines.ArraySequence
+            The streamlines of the view.
+
+        """
+        import nibabel as nib
+
+        parentStreamlines=self._parentStreamlines()
+        if hasattr(parentStreamlines,'_data'):
+            points, lengths=_gatherStreamlinePoints(parentStreamlines,self.indexes)
+            return _arraySequenceFromFlat(points,lengths)
+        if hasattr(parentStreamlines,'toArraySequence'):
+            return parentStreamlines[self.indexes].toArraySequence()
+        return nib.streamlines.ArraySequence(iter(self))
+
+    def toTractogram(self):
+        """
+        Materializes the view as a nibabel Tractogram.
+
+        Returns
+        -------
+        tractogram : nibabel.streamlines.tractogram.Tractogram
+            A tractogram holding a copy of the streamlines of the view.
+
+        """
+        import nibabel as nib
+
+        return nib.streamlines.tractogram.Tractogram(streamlines=self.materialize(),affine_to_rasmm=self.affine_to_rasmm)
+
+
+def extractSubTractogram(sourceTractogram, indexes):
+    """
+    Returns the selected streamlines of a tractogram as a SubTractogramView.
+    Replaces the notebooks' extractSubTractogram, which copied the selected
+    streamlines into a new Tractogram every time it was called.
+
+    Parameters
+    ----------
+    sourceTractogram : Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The tractogram to subset.
+    indexes : array-like of int or bool
+        The streamlines to select, e.g. an entry of the connectivity_matrix
+        grouping, or a boolean vector from a criteria function.
+
+    Returns
+    -------
+    subTractogram : SubTractogramView
+        View of the selected streamlines.
+
+    """
+    return SubTractogramView(sourceTractogram,indexes)
+
+
+def loadTractogramsParallel(tractogramPaths, nWorkers=None, blockSize=100000, verbose=False):
+    """
+    Loads several .tck files concurrently (e.g. the length-binned tractograms
+    of the example segmentations) into a single tractogram.  The points of
+    every file are decoded, by a pool of threads, directly into one
+    preallocated points buffer, in the order of the input paths.
+
+    Parameters
+    ----------
+    tractogramPaths : list of str
+        Paths to .tck files.
+    nWorkers : int, optional
+        Number of threads to use.  The default is one per file, up to the
+        number of available cpus.
+    blockSize : int, optional
+        Number of streamlines decoded at a time by each thread.  The default
+        is 100000.
+    verbose : bool, optional
+        Whether to print the per-file load report.  The default is False.
+
+    Returns
+    -------
+    tractogram : nibabel.streamlines.tractogram.Tractogram
+        Tractogram holding the streamlines of all of the files.
+    loadReport : list of dict
+        One dictionary per file, with the path, streamline count, point
+        count, size in MB, decode time in seconds and throughput in MB/s.
+
+    """
+    import nibabel as nib
+    import numpy as np
+    import os
+    import time
+    import warnings
+    from concurrent.futures import ThreadPoolExecutor
+
+    #work out how many points each file holds from its header and size
+    slotSizes=[]
+    for iPath in tractogramPaths:
+        if not iPath.lower().endswith('.tck'):
+            raise ValueError('loadTractogramsParallel only supports .tck files, got %s' % iPath)
+        header=nib.streamlines.tck.TckFile._read_header(iPath)
+        rowBytes=3*np.dtype(header['_dtype']).itemsize
+        rowCount=(os.path.getsize(iPath)-header['_offset_data'])//rowBytes
+        #each streamline is followed by a delimiter row, and the data by an end row
+        declaredCount=header.get('count',None)
+        if declaredCount is not None and str(declaredCount).strip().isdigit():
+            #a file declaring no streamlines gets an empty slot
+            declaredCount=int(declaredCount)
+            slotSizes.append(max(rowCount-declaredCount-1,0) if declaredCount>0 else 0)
+        else:
+            #the count wasn't recorded, so fall back to an upper bound
+            slotSizes.append(rowCount)
+    slotSizes=np.asarray(slotSizes,dtype=np.int64)
+    slotStarts=np.concatenate(([0],np.cumsum(slotSizes)[:-1])).astype(np.int64)
+
+    #the single allocation which every thread decodes into
+    points=np.empty((int(slotSizes.sum()),3),dtype=np.float32)
+
+    def decodeFile(iFile):
+        startTime=time.perf_counter()
+        writePosition=slotStarts[iFile]
+        slotEnd=slotStarts[iFile]+slotSizes[iFile]
+        fileLengths=[np.zeros(0,dtype=np.int64)]
+        for blockStart, blockStreamlines in iterateTckBlocks(tractogramPaths[iFile], blockSize=blockSize):
+            blockPoints=blockStreamlines._data
+            if writePosition+len(blockPoints)>slotEnd:
+                raise ValueError('%s holds more points than its header indicates' % tractogramPaths[iFile])
+            points[writePosition:writePosition+len(blockPoints)]=blockPoints
+            writePosition=writePosition+len(blockPoints)
+            fileLengths.append(blockStreamlines._lengths)
+        fileLengths=np.concatenate(fileLengths)
+        elapsed=time.perf_counter()-startTime
+        fileMB=os.path.getsize(tractogramPaths[iFile])/(1024*1024)
+        fileReport={'path':tractogramPaths[iFile],
+                    'nb_streamlines':len(fileLengths),
+                    'nb_points':int(writePosition-slotStarts[iFile]),
+                    'MB':fileMB,
+                    'seconds':elapsed,
+                    'MB_per_second':fileMB/elapsed if elapsed>0 else float('inf')}
+        return fileLengths, fileReport
+
+    if nWorkers is None:
+        nWorkers=min(len(tractogramPaths),os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(nWorkers,1)) as executor:
+        results=list(executor.map(decodeFile,range(len(tractogramPaths))))
+
+    #offsets point into each file's slot of the shared buffer
+    lengthsList=[]
+    offsetsList=[]
+    loadReport=[]
+    for iFile, (fileLengths, fileReport) in enumerate(results):
+        lengthsList.append(fileLengths)
+        #as in _arraySequenceFromFlat, so that a file without streamlines adds no offsets
+        fileOffsets=np.zeros(len(fileLengths),dtype=np.int64)
+        fileOffsets[1:]=np.cumsum(fileLengths)[:-1]
+        offsetsList.append(slotStarts[iFile]+fileOffsets)
+        loadReport.append(fileReport)
+        if fileReport['nb_points']!=slotSizes[iFile]:
+            #only happens when a header's count is missing or wrong
+            warnings.warn('%s did not fill its preallocated slot' % fileReport['path'])
+    lengths=np.concatenate(lengthsList) if len(lengthsList)>0 else np.zeros(0,dtype=np.int64)
+    offsets=np.concatenate(offsetsList) if len(offsetsList)>0 else np.zeros(0,dtype=np.int64)
+
+    streamlines=nib.streamlines.ArraySequence()
+    streamlines._data=points
+    streamlines._offsets=offsets
+    streamlines._lengths=lengths
+
+    if verbose:
+        for fileReport in loadReport:
+            print('%s: %i streamlines, %.1f MB in %.2f s (%.1f MB/s)' % (os.path.basename(fileReport['path']),
+                  fileReport['nb_streamlines'],fileReport['MB'],fileReport['seconds'],fileReport['MB_per_second']))
+
+    tractogram=nib.streamlines.tractogram.Tractogram(streamlines=streamlines,affine_to_rasmm=np.eye(4))
+    return tractogram, loadReport
+
+
+def iterateSequenceBlocks(streamlinesIn, blockSize=100000):
+    """
+    Splits an in-memory set of streamlines into blocks of a fixed number of
+    streamlines, each with contiguous point data.  The counterpart of
+    iterateTractogramBlocks for objects which have already been loaded.
+
+    Parameters
+    ----------
+    streamlinesIn : Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines to split.
+    blockSize : int, optional
+        Number of streamlines in each block.  The default is 100000.
+
+    Yields
+    ------
+    blockStart : int
+        Index of the first streamline in the block.
+    blockStreamlines : nibabel.streamlines.ArraySequence
+        The streamlines of the block, with contiguous data.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    streamlines=_asArraySequence(streamlinesIn)
+    for blockStart in range(0,len(streamlines),blockSize):
+        blockEnd=min(blockStart+blockSize,len(streamlines))
+        if hasattr(streamlines,'_data'):
+            blockPoints, blockLengths=_gatherStreamlinePoints(streamlines,np.arange(blockStart,blockEnd))
+            yield blockStart, _arraySequenceFromFlat(blockPoints,blockLengths)
+        elif hasattr(streamlines,'materialize'):
+            yield blockStart, streamlines[blockStart:blockEnd].materialize()
+        elif hasattr(streamlines,'toArraySequence'):
+            yield blockStart, streamlines[blockStart:blockEnd].toArraySequence()
+        else:
+            yield blockStart, nib.streamlines.ArraySequence([streamlines[iStream] for iStream in range(blockStart,blockEnd)])
+
+
+#identifies the compact quantized tractogram format written by saveQuantizedTractogram
+quantizedMagic=b'WiMSEqtk'
+
+
+def saveQuantizedTractogram(tractogramIn, outPath, precision=0.01, blockSize=100000, compressionLevel=6):
+    """
+    Saves a tractogram in a compact quantized format (conventionally with a
+    .qtk extension).  Each coordinate is rounded to a multiple of precision
+    (in mm), the first point of each streamline is stored as an int32 and the
+    remaining points as int16 steps from the previous point.  Blocks of
+    blockSize streamlines are zlib compressed independently, so the file can
+    be decoded block by block.
+
+    Because the steps are taken between already-rounded points, rounding
+    errors do not accumulate along a streamline: every decoded coordinate is
+    within precision/2 of the original.
+
+    Parameters
+    ----------
+    tractogramIn : str, Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The tractogram to save.  If str, the path to a tractogram file, which
+        is streamed block by block rather than loaded.
+    outPath : str
+        Path of the output file.
+    precision : float, optional
+        Quantization step, in mm.  The default is 0.01.
+    blockSize : int, optional
+        Number of streamlines in each compressed block.  The default is 100000.
+    compressionLevel : int, optional
+        zlib compression level, between 0 and 9.  The default is 6.
+
+    Returns
+    -------
+    outPath : str
+        The output path, for convenience.
+
+    """
+    import numpy as np
+    import json
+    import struct
+    import zlib
+
+    if isinstance(tractogramIn, str):
+        blockIterator=iterateTractogramBlocks(tractogramIn, blockSize=blockSize)
+    else:
+        blockIterator=iterateSequenceBlocks(tractogramIn, blockSize=blockSize)
+
+    blockIndex=[]
+    totalStreamlines=0
+    totalPoints=0
+    with open(outPath,'wb') as outFile:
+        outFile.write(quantizedMagic)
+        for blockStart, blockStreamlines in blockIterator:
+            lengths=np.asarray(blockStreamlines._lengths,dtype=np.int64)
+            quantized=np.rint(np.asarray(blockStreamlines._data,dtype=np.float64)/precision).astype(np.int64)
+            streamStarts=np.concatenate(([0],np.cumsum(lengths)[:-1])).astype(np.int64)
+            #every row which is not the first of its streamline is stored as a step
+            isStep=np.ones(len(quantized),dtype=bool)
+            isStep[streamStarts[lengths>0]]=False
+            stepRows=np.flatnonzero(isStep)
+            steps=quantized[stepRows]-quantized[stepRows-1]
+            if np.any(np.abs(steps)>np.iinfo(np.int16).max):
+                raise ValueError('streamline step too large to store at a precision of %g mm, use a coarser precision' % precision)
+            anchors=quantized[streamStarts[lengths>0]]
+            if np.any(np.abs(anchors)>np.iinfo(np.int32).max):
+                raise ValueError('coordinates too large to store at a precision of %g mm, use a coarser precision' % precision)
+            payload=(lengths.astype('<i4').tobytes()+anchors.astype('<i4').tobytes()+steps.astype('<i2').tobytes())
+            compressed=zlib.compress(payload,compressionLevel)
+            blockIndex.append({'offset':outFile.tell(),
+                               'nb_bytes':len(compressed),
+                               'nb_streamlines':int(len(lengths)),
+                               'nb_anchors':int(len(anchors)),
+                               'nb_points':int(len(quantized))})
+            outFile.write(compressed)
+            totalStreamlines=totalStreamlines+len(lengths)
+            totalPoints=totalPoints+len(quantized)
+
+        #the footer is written last, as the block sizes aren't known in advance
+        footer={'version':1,
+                'precision':precision,
+                'nb_streamlines':int(totalStreamlines),
+                'nb_points':int(totalPoints),
+                'affine_to_rasmm':np.asarray(getattr(tractogramIn,'affine_to_rasmm',np.eye(4))).tolist(),
+                'blocks':blockIndex}
+        footerBytes=json.dumps(footer).encode('utf-8')
+        outFile.write(footerBytes)
+        outFile.write(struct.pack('<Q',len(footerBytes)))
+
+    return outPath
+
+
+def _readQuantizedFooter(quantizedFile):
+    """
+    Reads the footer of an open quantized tractogram file.
+
+    Parameters
+    ----------
+    quantizedFile : file object
+        File opened in binary mode.
+
+    Returns
+    -------
+    footer : dict
+        The footer, including the block index.
+
+    """
+    import json
+    import os
+    import struct
+
+    quantizedFile.seek(0)
+    if quantizedFile.read(len(quantizedMagic))!=quantizedMagic:
+        raise ValueError('not a quantized tractogram file')
+    quantizedFile.seek(-8,os.SEEK_END)
+    footerLength=struct.unpack('<Q',quantizedFile.read(8))[0]
+    quantizedFile.seek(-8-footerLength,os.SEEK_END)
+    return json.loads(quantizedFile.read(footerLength).decode('utf-8'))
+
+
+def _decodeQuantizedBlock(compressed, blockInfo, precision, pointsOut=None):
+    """
+    Decodes one compressed block of a quantized tractogram.
+
+    Parameters
+    ----------
+    compressed : bytes
+        The compressed block.
+    blockInfo : dict
+        The block's entry in the footer's block index.
+    precision : float
+        Quantization step, in mm.
+    pointsOut : numpy.ndarray, optional
+        (nb_points, 3) float32 array to decode the points into.  If None, a
+        new array is allocated.
+
+    Returns
+    -------
+    points : numpy.ndarray
+        (nb_points, 3) float32 array of points.
+    lengths : numpy.ndarray
+        Number of points in each streamline.
+
+    """
+    import numpy as np
+    import zlib
+
+    payload=zlib.decompress(compressed)
+    nbStreamlines=blockInfo['nb_streamlines']
+    nbAnchors=blockInfo['nb_anchors']
+    nbPoints=blockInfo['nb_points']
+    lengths=np.frombuffer(payload,dtype='<i4',count=nbStreamlines).astype(np.int64)
+    anchorBytes=4*nbStreamlines
+    anchors=np.frombuffer(payload,dtype='<i4',count=nbAnchors*3,offset=anchorBytes).reshape(-1,3).astype(np.int64)
+    steps=np.frombuffer(payload,dtype='<i2',offset=anchorBytes+12*nbAnchors).reshape(-1,3)
+
+    if pointsOut is None:
+        pointsOut=np.empty((nbPoints,3),dtype=np.float32)
+    if nbPoints==0:
+        #e.g. a block made up only of empty streamlines
+        return pointsOut, lengths
+
+    nonEmpty=lengths[lengths>0]
+    streamStarts=np.concatenate(([0],np.cumsum(nonEmpty)[:-1])).astype(np.int64)
+    #place the steps, with zeros at the first point of each streamline
+    cumulative=np.zeros((nbPoints,3),dtype=np.int64)
+    isStep=np.ones(nbPoints,dtype=bool)
+    isStep[streamStarts]=False
+    cumulative[isStep]=steps
+    #a single cumulative sum, made relative to the start of each streamline
+    np.cumsum(cumulative,axis=0,out=cumulative)
+    cumulative=cumulative-np.repeat(cumulative[streamStarts]-anchors,nonEmpty,axis=0)
+
+    np.multiply(cumulative,precision,out=pointsOut,casting='unsafe')
+    return pointsOut, lengths
+
+
+def iterateQuantizedBlocks(quantizedPath):
+    """
+    Decodes a quantized tractogram file (see saveQuantizedTractogram) one
+    block at a time.
+
+    Parameters
+    ----------
+    quantizedPath : str
+        Path to the quantized tractogram file.
+
+    Yields
+    ------
+    blockStart : int
+        Index of the first streamline in the block.
+    blockStreamlines : nibabel.streamlines.ArraySequence
+        The decoded streamlines of the block.
+
+    """
+    with open(quantizedPath,'rb') as quantizedFile:
+        footer=_readQuantizedFooter(quantizedFile)
+        blockStart=0
+        for blockInfo in footer['blocks']:
+            quantizedFile.seek(blockInfo['offset'])
+            points, lengths=_decodeQuantizedBlock(quantizedFile.read(blockInfo['nb_bytes']),blockInfo,footer['precision'])
+            yield blockStart, _arraySequenceFromFlat(points,lengths)
+            blockStart=blockStart+blockInfo['nb_streamlines']
+
+
+def loadQuantizedTractogram(quantizedPath):
+    """
+    Loads a quantized tractogram file (see saveQuantizedTractogram), decoding
+    every block straight into a single flat float32 points array.
+
+    Parameters
+    ----------
+    quantizedPath : str
+        Path to the quantized tractogram file.
+
+    Returns
+    -------
+    tractogram : nibabel.streamlines.tractogram.Tractogram
+        The decoded tractogram.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    with open(quantizedPath,'rb') as quantizedFile:
+        footer=_readQuantizedFooter(quantizedFile)
+        points=np.empty((footer['nb_points'],3),dtype=np.float32)
+        lengthsList=[np.zeros(0,dtype=np.int64)]
+        pointStart=0
+        for blockInfo in footer['blocks']:
+            quantizedFile.seek(blockInfo['offset'])
+            pointEnd=pointStart+blockInfo['nb_points']
+            blockPoints, blockLengths=_decodeQuantizedBlock(quantizedFile.read(blockInfo['nb_bytes']),blockInfo,
+                                                            footer['precision'],pointsOut=points[pointStart:pointEnd])
+            lengthsList.append(blockLengths)
+            pointStart=pointEnd
+
+    streamlines=_arraySequenceFromFlat(points,np.concatenate(lengthsList))
+    return nib.streamlines.tractogram.Tractogram(streamlines=streamlines,affine_to_rasmm=np.asarray(footer['affine_to_rasmm']))
+
+
+#columns of the per-streamline metadata computed by computeStreamlineMetadata
+streamlineMetadataFields=['endpoint1','endpoint2','midpoint','minCoords','maxCoords','arcLength','nbPoints']
+
+
+def _isCompactSequence(streamlines):
+    """
+    Whether an ArraySequence's streamlines are stored back to back, in
+    order, from the start of its points array, i.e. whether its points can
+    be reduced per streamline with ufunc.reduceat.  Reordered views (e.g.
+    streamlines[::-1] or a fancy indexed selection) are not.
+    """
+    import numpy as np
+
+    lengths=np.asarray(streamlines._lengths,dtype=np.int64)
+    offsets=np.asarray(streamlines._offsets,dtype=np.int64)
+    if len(lengths)==0:
+        return True
+    return offsets[0]==0 and bool(np.all(np.diff(offsets)==lengths[:-1])) and lengths.sum()<=len(streamlines._data)
+
+
+def computeStreamlineMetadata(streamlinesIn):
+    """
+    Computes the per-streamline facts that are repeatedly needed by the
+    segmentation notebooks (endpoints, midpoint, per-axis extents and arc
+    length) for a block of streamlines, using whole-array operations rather
+    than a loop over streamlines.
+
+    Parameters
+    ----------
+    streamlinesIn : Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines.  Non-ArraySequence inputs are processed in blocks.
+
+    Returns
+    -------
+    metadata : dict of numpy.ndarray
+        'endpoint1' and 'endpoint2' : (N, 3) first and last node
+        'midpoint' : (N, 3) middle node (index nbPoints//2)
+        'minCoords' and 'maxCoords' : (N, 3) per-axis minimum and maximum
+        'arcLength' : (N,) summed internode distance, in mm
+        'nbPoints' : (N,) number of nodes
+        Streamlines without any nodes have NaN coordinates and an arcLength
+        of 0.
+
+    """
+    import numpy as np
+
+    streamlines=_asArraySequence(streamlinesIn)
+    if not hasattr(streamlines,'_data') or not _isCompactSequence(streamlines):
+        #process in compact blocks and stitch the results together
+        blockMetadata=[computeStreamlineMetadata(blockStreamlines) for blockStart, blockStreamlines in iterateSequenceBlocks(streamlines)]
+        if len(blockMetadata)==0:
+            return computeStreamlineMetadata(_arraySequenceFromFlat(np.zeros((0,3),dtype=np.float32),[]))
+        return {iField:np.concatenate([iBlock[iField] for iBlock in blockMetadata]) for iField in streamlineMetadataFields}
+
+    lengths=np.asarray(streamlines._lengths,dtype=np.int64)
+    starts=np.asarray(streamlines._offsets,dtype=np.int64)
+    points=np.asarray(streamlines._data[0:lengths.sum()],dtype=np.float32)
+    if len(lengths)==0:
+        emptyCoords=np.zeros((0,3),dtype=np.float32)
+        return {'endpoint1':emptyCoords,'endpoint2':emptyCoords,'midpoint':emptyCoords,
+                'minCoords':emptyCoords,'maxCoords':emptyCoords,
+                'arcLength':np.zeros(0,dtype=np.float32),'nbPoints':np.zeros(0,dtype=np.int64)}
+
+    #streamlines without points have no coordinates (NaN) and no length,
+    #and are left out of the reductions, which would otherwise return the
+    #next streamline's first value for them
+    isEmpty=lengths==0
+    filledStarts=starts[~isEmpty]
+    filledLengths=lengths[~isEmpty]
+    metadata={}
+    for iField in ['endpoint1','endpoint2','midpoint','minCoords','maxCoords']:
+        metadata[iField]=np.full((len(lengths),3),np.nan,dtype=np.float32)
+    metadata['arcLength']=np.zeros(len(lengths),dtype=np.float32)
+    metadata['nbPoints']=lengths
+    if len(filledStarts)==0:
+        return metadata
+
+    metadata['endpoint1'][~isEmpty]=points[filledStarts]
+    metadata['endpoint2'][~isEmpty]=points[filledStarts+filledLengths-1]
+    metadata['midpoint'][~isEmpty]=points[filledStarts+filledLengths//2]
+    metadata['minCoords'][~isEmpty]=np.minimum.reduceat(points,filledStarts,axis=0)
+    metadata['maxCoords'][~isEmpty]=np.maximum.reduceat(points,filledStarts,axis=0)
+    #internode distances, with the steps between streamlines zeroed out
+    nodeSteps=np.zeros(len(points),dtype=np.float32)
+    nodeSteps[1:]=np.sqrt(np.sum(np.square(np.diff(points,axis=0)),axis=1))
+    nodeSteps[filledStarts]=0
+    metadata['arcLength'][~isEmpty]=np.add.reduceat(nodeSteps,filledStarts)
+    return metadata
+
+
+def _bufferEndpoints(points, offsets, lengths):
+    """
+    Reads the first and last node of each streamline from a flat points
+    buffer.  Streamlines without nodes get NaN endpoints, rather than a
+    neighbouring streamline's nodes (or, for the first streamline, the last
+    node of the buffer).
+    """
+    import numpy as np
+
+    hasNodes=lengths>0
+    endpoint1=np.full((len(lengths),3),np.nan,dtype=np.result_type(points.dtype,np.float32))
+    endpoint2=endpoint1.copy()
+    endpoint1[hasNodes]=points[offsets[hasNodes]]
+    endpoint2[hasNodes]=points[offsets[hasNodes]+lengths[hasNodes]-1]
+    return endpoint1, endpoint2
+
+
+def streamlineEndpoints(streamlinesIn, blockSize=100000):
+    """
+    Gathers the first and last node of every streamline directly from the
+    flat points / offsets buffers of the streamlines, with one fancy
+    indexing operation per buffer rather than a loop over streamlines.
+    Only the endpoint rows are read, so memory mapped (see
+    loadFlatTractogram) and multi-file inputs are not copied.
+
+    Parameters
+    ----------
+    streamlinesIn : str, Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The streamlines.  If str, the path to a tractogram file, which is
+        read block by block with iterateTractogramBlocks.
+    blockSize : int, optional
+        Number of streamlines in each block read from a file.  The default
+        is 100000.
+
+    Returns
+    -------
+    endpoint1 : numpy.ndarray
+        (N, 3) first node of each streamline.
+    endpoint2 : numpy.ndarray
+        (N, 3) last node of each streamline.
+        Streamlines without any nodes have NaN endpoints.
+
+    """
+    import numpy as np
+
+    if isinstance(streamlinesIn, str):
+        blockEndpoints=[streamlineEndpoints(blockStreamlines) for blockStart, blockStreamlines in iterateTractogramBlocks(streamlinesIn,blockSize=blockSize)]
+    else:
+        streamlines=_asArraySequence(streamlinesIn)
+        if isinstance(streamlines, SubTractogramView):
+            parentStreamlines=streamlines._parentStreamlines()
+            if hasattr(parentStreamlines,'_data'):
+                offsets=np.asarray(parentStreamlines._offsets,dtype=np.int64)[streamlines.indexes]
+                lengths=np.asarray(parentStreamlines._lengths,dtype=np.int64)[streamlines.indexes]
+                return _bufferEndpoints(parentStreamlines._data,offsets,lengths)
+            #e.g. a MultiFileTractogram parent, whose subsets are views
+            streamlines=_asArraySequence(parentStreamlines[streamlines.indexes])
+        if hasattr(streamlines,'_data'):
+            offsets=np.asarray(streamlines._offsets,dtype=np.int64)
+            lengths=np.asarray(streamlines._lengths,dtype=np.int64)
+            return _bufferEndpoints(streamlines._data,offsets,lengths)
+        if isinstance(streamlines, MultiFileTractogram):
+            blockEndpoints=[streamlineEndpoints(iSequence) for iSequence in streamlines.sequences]
+        else:
+            blockEndpoints=[streamlineEndpoints(blockStreamlines) for blockStart, blockStreamlines in iterateSequenceBlocks(streamlines,blockSize=blockSize)]
+
+    if len(blockEndpoints)==0:
+        return np.zeros((0,3),dtype=np.float32), np.zeros((0,3),dtype=np.float32)
+    return np.concatenate([iBlock[0] for iBlock in blockEndpoints]), np.concatenate([iBlock[1] for iBlock in blockEndpoints])
+
+
+def buildStreamlineMetadata(tractogramPaths, sidecarPath, blockSize=100000):
+    """
+    Computes the per-streamline metadata (see computeStreamlineMetadata) of
+    one or more tractogram files, block by block, and saves it to a sidecar
+    .npz file along with the content hash of the files.
+
+    Parameters
+    ----------
+    tractogramPaths : str or list of str
+        Path(s) to the tractogram file(s).  Multiple files are treated as if
+        they were concatenated.
+    sidecarPath : str
+        Path of the output .npz file, used as is (i.e. without adding an
+        .npz extension).
+    blockSize : int, optional
+        Number of streamlines processed at a time.  The default is 100000.
+
+    Returns
+    -------
+    metadata : dict of numpy.ndarray
+        The per-streamline metadata.
+
+    """
+    import numpy as np
+    import json
+    from . import WiMSE_cacheFuncs
+
+    if isinstance(tractogramPaths, str):
+        tractogramPaths=[tractogramPaths]
+
+    blockMetadata=[]
+    for iPath in tractogramPaths:
+        for blockStart, blockStreamlines in iterateTractogramBlocks(iPath, blockSize=blockSize):
+            blockMetadata.append(computeStreamlineMetadata(blockStreamlines))
+    if len(blockMetadata)==0:
+        blockMetadata.append(computeStreamlineMetadata(_arraySequenceFromFlat(np.zeros((0,3),dtype=np.float32),[])))
+    metadata={iField:np.concatenate([iBlock[iField] for iBlock in blockMetadata]) for iField in streamlineMetadataFields}
+
+    contentHash, fileHashes=WiMSE_cacheFuncs.hashFiles(tractogramPaths)
+    #writing through a file object keeps the name exactly, as np.savez appends .npz to paths lacking it
+    with open(sidecarPath,'wb') as sidecarFile:
+        np.savez(sidecarFile,contentHash=np.asarray(contentHash),fileHashes=np.asarray(json.dumps(fileHashes)),**metadata)
+    return metadata
+
+
+def loadStreamlineMetadata(sidecarPath, tractogramPaths=None):
+    """
+    Loads a per-streamline metadata sidecar written by buildStreamlineMetadata.
+    No streamline point data is read.  If the tractogram path(s) are given,
+    the sidecar is checked against their content hash; files whose size and
+    modification time are unchanged are not re-hashed.
+
+    Parameters
+    ----------
+    sidecarPath : str
+        Path of the .npz sidecar.
+    tractogramPaths : str or list of str, optional
+        Path(s) to the tractogram file(s) the sidecar should describe.
+
+    Returns
+    -------
+    metadata : dict of numpy.ndarray
+        The per-streamline metadata.
+
+    """
+    import numpy as np
+    import json
+    from . import WiMSE_cacheFuncs
+
+    with np.load(sidecarPath) as sidecar:
+        if tractogramPaths is not None:
+            storedHashes=json.loads(str(sidecar['fileHashes']))
+            currentHash, currentFileHashes=WiMSE_cacheFuncs.hashFiles(tractogramPaths,knownHashes=storedHashes)
+            if currentHash!=str(sidecar['contentHash']):
+                raise ValueError('%s does not match the content of the tractogram, rebuild it with buildStreamlineMetadata' % sidecarPath)
+        metadata={iField:sidecar[iField] for iField in streamlineMetadataFields}
+    return metadata
+
+
+#axis and direction of each anatomical requirement, in RAS+ coordinates
+anatomicalDirections={'right':(0,1),'left':(0,-1),
+                      'anterior':(1,1),'posterior':(1,-1),
+                      'superior':(2,1),'inferior':(2,-1)}
+
+
+def planeCoordinate(planarROI, requirement):
+    """
+    Returns the RAS+ coordinate of an axis-aligned planar ROI (e.g. the
+    output of WMA_pyFuncs.planarROIFromAtlasLabelBorder) along the axis
+    relevant to an anatomical requirement.
+
+    Parameters
+    ----------
+    planarROI : nibabel.Nifti1Image or float
+        The planar ROI.  If a number is passed it is returned as is.
+    requirement : str
+        One of 'right', 'left', 'anterior', 'posterior', 'superior' or
+        'inferior'.
+
+    Returns
+    -------
+    coordinate : float
+        Coordinate of the plane, in mm.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if np.isscalar(planarROI):
+        return float(planarROI)
+    axis=anatomicalDirections[requirement][0]
+    planeVoxels=np.argwhere(np.asanyarray(planarROI.dataobj)!=0)
+    if len(planeVoxels)==0:
+        raise ValueError('planar ROI is empty')
+    planeCoords=nib.affines.apply_affine(planarROI.affine,planeVoxels)
+    return float(np.mean(planeCoords[:,axis]))
+
+
+def applyEndpointCriteriaFromMetadata(metadata, planarROI, requirement, whichEndpoints):
+    """
+    Metadata-based counterpart of WMA_pyFuncs.applyEndpointCriteria: finds
+    the streamlines whose endpoints lie beyond a plane in a given direction,
+    without touching the streamline points.
+
+    Parameters
+    ----------
+    metadata : dict of numpy.ndarray
+        Output of computeStreamlineMetadata or loadStreamlineMetadata.
+    planarROI : nibabel.Nifti1Image or float
+        The plane, or its coordinate in mm along the relevant axis.
+    requirement : str
+        Direction the endpoints must lie in relative to the plane, one of
+        'right', 'left', 'anterior', 'posterior', 'superior' or 'inferior'.
+    whichEndpoints : str
+        'both', 'one' (exactly one), 'either' (at least one) or 'neither'.
+
+    Returns
+    -------
+    criteriaBool : numpy.ndarray
+        Boolean vector with one entry per streamline.
+
+    """
+    import numpy as np
+
+    axis, direction=anatomicalDirections[requirement]
+    coordinate=planeCoordinate(planarROI, requirement)
+    firstBeyond=direction*(metadata['endpoint1'][:,axis]-coordinate)>0
+    lastBeyond=direction*(metadata['endpoint2'][:,axis]-coordinate)>0
+    if whichEndpoints=='both':
+        return np.logical_and(firstBeyond,lastBeyond)
+    elif whichEndpoints=='one':
+        return np.logical_xor(firstBeyond,lastBeyond)
+    elif whichEndpoints=='either':
+        return np.logical_or(firstBeyond,lastBeyond)
+    elif whichEndpoints=='neither':
+        return np.logical_not(np.logical_or(firstBeyond,lastBeyond))
+    raise ValueError("whichEndpoints must be 'both', 'one', 'either' or 'neither', not %s" % whichEndpoints)
+
+
+def applyMidpointCriteriaFromMetadata(metadata, planarROI, requirement):
+    """
+    Metadata-based counterpart of WMA_pyFuncs.applyMidpointCriteria: finds
+    the streamlines whose midpoint lies beyond a plane in a given direction.
+
+    Parameters
+    ----------
+    metadata : dict of numpy.ndarray
+        Output of computeStreamlineMetadata or loadStreamlineMetadata.
+    planarROI : nibabel.Nifti1Image or float
+        The plane, or its coordinate in mm along the relevant axis.
+    requirement : str
+        Direction the midpoint must lie in relative to the plane, one of
+        'right', 'left', 'anterior', 'posterior', 'superior' or 'inferior'.
+
+    Returns
+    -------
+    criteriaBool : numpy.ndarray
+        Boolean vector with one entry per streamline.
+
+    """
+    axis, direction=anatomicalDirections[requirement]
+    coordinate=planeCoordinate(planarROI, requirement)
+    return direction*(metadata['midpoint'][:,axis]-coordinate)>0
+
+
+def applyPlaneCrossingFromMetadata(metadata, planarROI, requirement):
+    """
+    Uses the per-axis extents to find the streamlines that could reach a
+    plane.  A streamline whose extent does not span the plane coordinate
+    cannot intersect it, so this is a cheap pre-filter for
+    WMA_pyFuncs.applyNiftiCriteriaToTract with a planar ROI.
+
+    Parameters
+    ----------
+    metadata : dict of numpy.ndarray
+        Output of computeStreamlineMetadata or loadStreamlineMetadata.
+    planarROI : nibabel.Nifti1Image or float
+        The plane, or its coordinate in mm along the relevant axis.
+    requirement : str
+        Any direction along the plane's normal axis, e.g. 'anterior' or
+        'posterior' for a coronal plane.
+
+    Returns
+    -------
+    spansBool : numpy.ndarray
+        Boolean vector, True for the streamlines whose extent spans the plane.
+
+    """
+    import numpy as np
+
+    axis=anatomicalDirections[requirement][0]
+    coordinate=planeCoordinate(planarROI, requirement)
+    return np.logical_and(metadata['minCoords'][:,axis]<=coordinate,metadata['maxCoords'][:,axis]>=coordinate)
+
+
+def streamlineEfficiency(metadata):
+    """
+    Computes the efficiency of each streamline (as in the
+    Biological_Plausibility_for_Tractograms chapter): the straight line
+    distance between its endpoints divided by its arc length.
+
+    Parameters
+    ----------
+    metadata : dict of numpy.ndarray
+        Output of computeStreamlineMetadata or loadStreamlineMetadata.
+
+    Returns
+    -------
+    efficiencies : numpy.ndarray
+        One value per streamline, between 0 and 1.  Single-node streamlines
+        are given an efficiency of 1.
+
+    """
+    import numpy as np
+
+    displacement=np.sqrt(np.sum(np.square(metadata['endpoint2']-metadata['endpoint1']),axis=1))
+    arcLength=metadata['arcLength']
+    efficiencies=np.ones(len(arcLength),dtype=np.float32)
+    hasLength=arcLength>0
+    efficiencies[hasLength]=displacement[hasLength]/arcLength[hasLength]
+    return efficiencies
+
+
+def sampleTractogramStreamlines(tractogramPath, sampleSize=10, seed=None, blockSize=100000):
+    """
+    Draws a uniform random sample of streamlines from a tractogram file
+    without loading the whole file, e.g. to preview a handful of streamlines
+    from a whole brain tractogram.
+
+    If a flat tractogram store (see convertTractogramToFlat) exists for the
+    path, either because the path is its stem or because it shares the
+    tractogram's name (e.g. smallTractogram.tck and smallTractogram_header.json),
+    the sampled streamlines are read directly via their offsets.  Otherwise
+    the file is read once, block by block, while a reservoir of sampleSize
+    streamlines is maintained (reservoir sampling), so memory use never
+    exceeds one block.
+
+    Parameters
+    ----------
+    tractogramPath : str
+        Path to a tractogram file, or the stem of a flat tractogram store.
+    sampleSize : int, optional
+        Number of streamlines to sample.  The default is 10.
+    seed : int, optional
+        Seed for the random number generator.  The default is None.
+    blockSize : int, optional
+        Number of streamlines read at a time when streaming.  The default is
+        100000.
+
+    Returns
+    -------
+    sampleTractogram : nibabel.streamlines.tractogram.Tractogram
+        Tractogram holding the sampled streamlines, in the order they appear
+        in the file.
+    sampleIndexes : numpy.ndarray
+        Indexes of the sampled streamlines within the whole tractogram.
+
+    """
+    import nibabel as nib
+    import numpy as np
+    import os
+
+    rng=np.random.default_rng(seed)
+
+    #look for a flat store, which allows random access
+    flatStem=None
+    for iStem in [tractogramPath, os.path.splitext(tractogramPath)[0]]:
+        if os.path.exists(flatTractogramPaths(iStem)[2]):
+            flatStem=iStem
+            break
+    if flatStem is not None:
+        flatTractogram=loadFlatTractogram(flatStem)
+        streamCount=len(flatTractogram.streamlines)
+        sampleIndexes=np.sort(rng.choice(streamCount,size=min(sampleSize,streamCount),replace=False))
+        sampleTractogram=SubTractogramView(flatTractogram,sampleIndexes).toTractogram()
+        return sampleTractogram, sampleIndexes
+
+    #otherwise stream the file through a reservoir
+    reservoir=[]
+    reservoirIndexes=[]
+    for blockStart, blockStreamlines in iterateTractogramBlocks(tractogramPath, blockSize=blockSize):
+        globalIndexes=np.arange(blockStart,blockStart+len(blockStreamlines))
+        #fill the reservoir first
+        fillCount=max(min(sampleSize-len(reservoir),len(blockStreamlines)),0)
+        for iStream in range(fillCount):
+            reservoir.append(np.array(blockStreamlines[iStream]))
+            reservoirIndexes.append(int(globalIndexes[iStream]))
+        #then the i-th streamline replaces a random entry with probability sampleSize/(i+1)
+        candidates=globalIndexes[fillCount:]
+        replacementSlots=(rng.random(len(candidates))*(candidates+1)).astype(np.int64)
+        for iCandidate in np.flatnonzero(replacementSlots<sampleSize):
+            reservoir[replacementSlots[iCandidate]]=np.array(blockStreamlines[fillCount+iCandidate])
+            reservoirIndexes[replacementSlots[iCandidate]]=int(candidates[iCandidate])
+
+    sampleOrder=np.argsort(reservoirIndexes)
+    sampleIndexes=np.asarray(reservoirIndexes,dtype=np.int64)[sampleOrder]
+    sampleStreamlines=nib.streamlines.ArraySequence([reservoir[iSample] for iSample in sampleOrder])
+    #the blocks are always in RAS+ mm
+    sampleTractogram=nib.streamlines.tractogram.Tractogram(streamlines=sampleStreamlines,affine_to_rasmm=np.eye(4))
+    return sampleTractogram, sampleIndexes
+
+
+def _tckHeaderBytes(streamCount, totalCount):
+    """
+    Builds the text header of a .tck file, with the data offset ("file"
+    field) pointing just past the header.
+
+    Parameters
+    ----------
+    streamCount : int
+        Number of streamlines in the file.
+    totalCount : int
+        Number of streamlines they were selected from.
+
+    Returns
+    -------
+    headerBytes : bytes
+        The encoded header.
+
+    """
+    headerLines=['mrtrix tracks',
+                 'count: %010i' % streamCount,
+                 'datatype: Float32LE',
+                 'total_count: %i' % totalCount]
+    #the offset depends on its own number of digits, so iterate until it is stable
+    dataOffset=0
+    while True:
+        headerText='\n'.join(headerLines+['file: . %i' % dataOffset,'END'])+'\n'
+        if len(headerText.encode('latin-1'))==dataOffset:
+            return headerText.encode('latin-1')
+        dataOffset=len(headerText.encode('latin-1'))
+
+
+def saveSubTractogram(sourceTractogram, selection, outPath, referenceImg=None, batchSize=100000):
+    """
+    Saves selected streamlines of a tractogram (e.g. the output of
+    WMA_pyFuncs.applyNiftiCriteriaToTract, or an entry of a connectivity
+    grouping) to a .tck or .trk file.  The points are gathered straight from
+    the source's flat point buffer in batches, and written with a header
+    whose streamline counts are set correctly, without building any
+    intermediate Tractogram objects.
+
+    Parameters
+    ----------
+    sourceTractogram : Tractogram, ArraySequence, MultiFileTractogram or SubTractogramView
+        The tractogram the streamlines are selected from.
+    selection : array-like of bool or int
+        Boolean vector with one entry per source streamline, or indexes of
+        the streamlines to save.
+    outPath : str
+        Path of the output file, ending in .tck or .trk.
+    referenceImg : nibabel.Nifti1Image or str, optional
+        Reference image (or path to one) defining the voxel grid of a .trk
+        file.  Required for .trk output, ignored for .tck output.
+    batchSize : int, optional
+        Number of streamlines gathered and written at a time.  The default
+        is 100000.
+
+    Returns
+    -------
+    streamCount : int
+        Number of streamlines written.
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    selection=np.asarray(selection)
+    if selection.dtype==bool:
+        selection=np.flatnonzero(selection)
+    selection=selection.astype(np.int64).reshape(-1)
+    streamCount=len(selection)
+    totalCount=len(_asArraySequence(sourceTractogram))
+
+    if outPath.lower().endswith('.tck'):
+        with open(outPath,'wb') as outFile:
+            outFile.write(_tckHeaderBytes(streamCount,totalCount))
+            for batchStart in range(0,streamCount,batchSize):
+                batchStreamlines=SubTractogramView(sourceTractogram,selection[batchStart:batchStart+batchSize]).materialize()
+                lengths=np.asarray(batchStreamlines._lengths,dtype=np.int64)
+                #each streamline is followed by a nan delimiter row
+                outRows=np.full((int(lengths.sum())+len(lengths),3),np.nan,dtype='<f4')
+                pointRows=np.arange(lengths.sum(),dtype=np.int64)+np.repeat(np.arange(len(lengths),dtype=np.int64),lengths)
+                outRows[pointRows]=batchStreamlines._data
+                outRows.tofile(outFile)
+            #the data ends with an infinite row
+            np.full((1,3),np.inf,dtype='<f4').tofile(outFile)
+
+    elif outPath.lower().endswith('.trk'):
+        from nibabel.streamlines.trk import TrkFile, get_affine_rasmm_to_trackvis
+        if referenceImg is None:
+            raise ValueError('a reference image is required to save a .trk file')
+        if isinstance(referenceImg, str):
+            referenceImg=nib.load(referenceImg)
+        header=TrkFile._default_structarr(endianness='little')
+        header['dimensions']=referenceImg.shape[:3]
+        header['voxel_sizes']=referenceImg.header.get_zooms()[:3]
+        header['voxel_to_rasmm']=referenceImg.affine
+        header['voxel_order']=''.join(nib.aff2axcodes(referenceImg.affine)).encode('latin1')
+        header['nb_streamlines']=streamCount
+        #trk stores points in voxmm space
+        affineToTrackvis=get_affine_rasmm_to_trackvis(header)
+        with open(outPath,'wb') as outFile:
+            outFile.write(header.tobytes())
+            for batchStart in range(0,streamCount,batchSize):
+                batchStreamlines=SubTractogramView(sourceTractogram,selection[batchStart:batchStart+batchSize]).materialize()
+                lengths=np.asarray(batchStreamlines._lengths,dtype=np.int64)
+                voxmmPoints=nib.affines.apply_affine(affineToTrackvis,batchStreamlines._data)
+                #each streamline is an int32 point count followed by its points
+                outValues=np.zeros(3*int(lengths.sum())+len(lengths),dtype='<f4')
+                streamIndexes=np.arange(len(lengths),dtype=np.int64)
+                streamStarts=np.concatenate(([0],np.cumsum(lengths)[:-1])).astype(np.int64)
+                outValues.view('<i4')[3*streamStarts+streamIndexes]=lengths
+                pointPositions=3*np.arange(lengths.sum(),dtype=np.int64)+np.repeat(streamIndexes,lengths)+1
+                outValues[pointPositions[:,None]+np.arange(3)]=voxmmPoints
+                outValues.tofile(outFile)
+    else:
+        raise ValueError('output must be a .tck or .trk file, not %s' % outPath)
+
+    return streamCount
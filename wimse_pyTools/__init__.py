@@ -0,0 +1,8 @@
+"""
+Helper functions used by the WiMSE notebooks.
+
+Load from the top of the WiMSE repository, e.g.
+
+    os.chdir(gitRepoPath)
+    from wimse_pyTools import WiMSE_tractFuncs
+"""